@@ -8,7 +8,12 @@
 
 import os
 import json
+import time
+import tarfile
+import tempfile
 import textwrap
+import collections
+import types
 
 import hashlib
 import base64
@@ -17,9 +22,8 @@ import datetime
 import irods
 from irods.session import iRODSSession
 import irods.exception as ex
-from irods.column import Criterion
+from irods.column import Criterion, In
 from irods.data_object import chunks
-import irods.test.helpers as helpers
 import irods.keywords as kw
 from irods.meta import iRODSMeta
 from irods.models import (DataObject, Collection, Resource, User, DataObjectMeta,CollectionMeta, ResourceMeta, UserMeta)
@@ -28,6 +32,11 @@ from irods.rule import Rule
 from irods.meta import iRODSMetaCollection
 from irods.exception import CollectionDoesNotExist
 
+from wfchecksum import checksums
+
+# parsed .r file, see irodsDAO.load_rule
+RuleTemplate = collections.namedtuple('RuleTemplate', ['body', 'params', 'output'])
+
 class irodsDAO():
     """Data access object class for iRODS."""
 
@@ -38,6 +47,17 @@ class irodsDAO():
         self.log = log
         self.config = config
 
+        # collections known to exist in the current session
+        self.collections = set()
+        # collection -> {data object name -> set of checksums}
+        self.collectionObjects = {}
+        # rule file -> (mtime, RuleTemplate)
+        self.rules = {}
+        # cleared when the server refuses parallel transfers
+        self.parallelTransfer = True
+        # compound resource -> name of its cache resource
+        self.cacheResources = {}
+
     def _irodsConnect(self):
         """Checks whether there is a connection to iRODS estabilshed, and if
         there isn't, connects to iRODS, using the stored configuration."""
@@ -52,12 +72,20 @@ class irodsDAO():
                                     user=str(self.config['IRODS']['USER']),
                                     password=str(self.config['IRODS']['PWD']),
                                     zone=str(self.config['IRODS']['ZONE']))
+        self.collections = set()
+        self.collectionObjects = {}
         self.log.info("done")
 
 
-    def doRegister(self, dirname, collname, filename):   
+    def doRegister(self, dirname, collname, filename,
+                   register_checksum=False,
+                   check='none'):
         """Registers file in iRODS.
 
+        When the file is under a local prefix of IRODS.VAULT_MAP, it is
+        registered in place in the resource IRODS.REGISTER_RESOURCE with
+        the physical path seen by the resource server, see `getVaultPath`.
+
         Parameters
         ----------
         dirname : `str`
@@ -66,6 +94,17 @@ class irodsDAO():
             iRODS collection where the file should be registered.
         filename : `str`
             The name of both the local file and the iRODS data object.
+        register_checksum : `bool`, optional
+            Whether or not to register the SHA256 checksum in iRODS along
+            the data object (default False).
+        check : {'none', 'ausent', 'updated'}, optional
+            Same as in `doPut`. When the file is registered with a
+            different checksum, the registration is forced (default 'none').
+
+        Returns
+        -------
+        `bool`
+            False if the file could not be registered.
         """
 
         self._irodsConnect()
@@ -78,14 +117,36 @@ class irodsDAO():
         self.log.info("check obj_file : "+obj_file)
         self.log.info("check obj_path : "+obj_path)
 
-        self.log.info("check or create a collection recursively : "+collname)
+        if self._isInIrods(obj_file, collname, filename, check, 'Registration'):
+            return True
+
+        # Set register options
+        options = {}
+        phys_path = self.getVaultPath(obj_file)
+        if phys_path is None:
+            phys_path = obj_file
+        else:
+            options[kw.RESC_NAME_KW] = self.config['IRODS']['REGISTER_RESOURCE']
+        if register_checksum:
+            options[kw.REG_CHKSUM_KW] = ''
+        if filename in self.collectionObjects.get(collname, {}):
+            options[kw.FORCE_FLAG_KW] = ''
+
         try:
-            self.session.data_objects.register(obj_file, obj_path)
+            self.session.data_objects.register(phys_path, obj_path, **options)
             self.log.info("file registered! : "+obj_path)
         except Exception as ex:
             self.log.error("Could not register a file_obj  ")         
             self.log.error(ex)
-            pass
+            self.collections.discard(collname)
+            self.collectionObjects.pop(collname, None)
+            return False
+
+        if collname in self.collectionObjects:
+            obj_hash = "sha2:" + checksums.sha256(obj_file) if register_checksum else None
+            self.collectionObjects[collname][filename] = set([obj_hash])
+
+        return True
 
         # confirm object presence
         #obj = self.session.data_objects.get(obj_path)
@@ -93,6 +154,77 @@ class irodsDAO():
         #print("registred!")
         #print (obj)
        
+    def getVaultPath(self, file):
+        """Returns the physical path of a local file as seen by the iRODS
+        resource server, from the longest matching local prefix of
+        IRODS.VAULT_MAP, or None if the file is not on a vault.
+
+        Parameters
+        ----------
+        file : `str`
+            Full file path in the local filesystem.
+        """
+
+        match = None
+        for prefix in self.config['IRODS']['VAULT_MAP']:
+            # match whole path components only
+            if file != prefix and not file.startswith(prefix.rstrip(os.sep) + os.sep):
+                continue
+            if match is None or len(prefix) > len(match):
+                match = prefix
+
+        if match is None:
+            return None
+
+        return self.config['IRODS']['VAULT_MAP'][match] + file[len(match):]
+
+    def _isInIrods(self, obj_file, collname, filename, check, action):
+        """Checks whether a file is already in iRODS, following the check
+        policy of `doPut`.
+
+        Parameters
+        ----------
+        obj_file : `str`
+            Full file path in the local filesystem.
+        collname : `str`
+            iRODS collection of the data object.
+        filename : `str`
+            Name of the data object.
+        check : {'none', 'ausent', 'updated'}
+            See `doPut`.
+        action : `str`
+            Name of the canceled action, for the log.
+
+        Returns
+        -------
+        `bool`
+            True if the file must not be ingested.
+        """
+
+        if check != 'ausent' and check != 'updated':
+            return False
+
+        # Check whether the file is already in irods
+        objects = self.getCollectionObjects(collname)
+        if filename not in objects:
+            return False
+
+        if check == 'ausent':
+            self.log.info("File already in iRODS. " + action + " canceled.")
+            return True
+
+        # Compare checksums, exit if they're equal
+        file_hash = "sha2:" + checksums.sha256(obj_file)
+        for obj_hash in objects[filename]:
+
+            self.log.info("DataObject.checksum: " + str(obj_hash))
+            self.log.info("File checksum:       " + file_hash)
+            if obj_hash == file_hash:
+                self.log.info("File already in iRODS. " + action + " canceled.")
+                return True
+
+        return False
+
     def doPut(self, dirname, collname, filename,
               purge_cache=True,
               register_checksum=False,
@@ -104,6 +236,13 @@ class irodsDAO():
         the same time in iCAT. The hashing algorithm used to compute
         the checksum is SHA256.
 
+        Files of at least IRODS.PARALLEL_THRESHOLD bytes are transferred
+        over IRODS.PARALLEL_THREADS parallel streams. If the parallel
+        transfer itself fails (python-irodsclient raises a RuntimeError,
+        e.g. when the server data ports are not reachable), the file and
+        the following ones are transferred over a single stream. iRODS
+        errors (permissions, overwrite, quota...) fail the put.
+
         Parameters
         ----------
         dirname : `str`
@@ -126,6 +265,11 @@ class irodsDAO():
             or if its SHA256 checksum is different from the one in
             iCAT. Make sure to only use 'updated' if the data objects
             checksums are correctly registered (default 'ausent').
+
+        Returns
+        -------
+        `bool`
+            False if the file could not be put.
         """
 
         self._irodsConnect()
@@ -137,26 +281,8 @@ class irodsDAO():
         self.log.info("check obj_file : "+obj_file)
         self.log.info("check obj_path : "+obj_path)
 
-        if check == 'ausent' or check == 'updated':
-
-            # Check whether the file is already in irods
-            query = self.session.query(DataObject.name, DataObject.checksum).filter(DataObject.name == filename)
-            if len(query.execute()) > 0:
-
-                if check == 'ausent':
-                    self.log.info("File already in iRODS. Put canceled.")
-                    return
-
-                # Compare checksums, exit if they're equal
-                for result in query:
-                    obj_hash = result[DataObject.checksum]
-                    file_hash = "sha2:" + helpers.compute_sha256_digest(obj_file)
-
-                    self.log.info("DataObject.checksum: " + obj_hash)
-                    self.log.info("File checksum:       " + file_hash)
-                    if obj_hash == file_hash:
-                        self.log.info("File already in iRODS. Put canceled.")
-                        return
+        if self._isInIrods(obj_file, collname, filename, check, 'Put'):
+            return True
 
         # Set put options
         options = {kw.RESC_NAME_KW: "compResc"}
@@ -165,13 +291,170 @@ class irodsDAO():
         if register_checksum:
             options[kw.REG_CHKSUM_KW] = ''
 
+        # Files above the threshold go over parallel streams
+        size = os.path.getsize(obj_file)
+        num_threads = 1
+        if self.parallelTransfer and size >= self.config['IRODS']['PARALLEL_THRESHOLD']:
+            num_threads = max(1, self.config['IRODS']['PARALLEL_THREADS'])
+
+        start = time.time()
         try:
-            self.session.data_objects.put(obj_file, obj_path, **options)
+            try:
+                self.session.data_objects.put(obj_file, obj_path, num_threads=num_threads, **options)
+            except RuntimeError as ex:
+                if num_threads == 1:
+                    raise
+                self.log.warning("Parallel transfer refused, falling back to a single stream")
+                self.log.warning(ex)
+                self.parallelTransfer = False
+                num_threads = 1
+                start = time.time()
+                self.session.data_objects.put(obj_file, obj_path, num_threads=num_threads, **options)
             self.log.info("file put! : "+obj_path)
         except Exception as ex:
             self.log.error("Could not put a file_obj  ")         
             self.log.error(ex)
-            pass
+            self.collections.discard(collname)
+            self.collectionObjects.pop(collname, None)
+            return False
+
+        elapsed = time.time() - start
+        self.log.info("Transferred %.1f MB in %.2f s (%.2f MB/s, %d stream(s))" %
+                      (size / 1e6, elapsed, size / 1e6 / elapsed if elapsed > 0 else 0, num_threads))
+
+        if collname in self.collectionObjects:
+            obj_hash = "sha2:" + checksums.sha256(obj_file) if register_checksum else None
+            self.collectionObjects[collname][filename] = set([obj_hash])
+
+        return True
+
+
+    def doBundlePut(self, collname, files, rule_path,
+                    purge_cache=True,
+                    register_checksum=False):
+        """Puts many files in a collection as a single tar bundle.
+
+        The files not yet in the collection are packed in a tar file, which
+        is put in the compound resource compResc. The rule in rule_path
+        extracts it server-side into individual data objects (as
+        ``ibun -x``), registers their SHA256 checksums in iCAT and trims
+        their replicas in the cache resource, and the bundle is removed.
+        Data objects whose size or checksum does not match the local file
+        are removed, so they are put again by `doPut`.
+
+        Parameters
+        ----------
+        collname : `str`
+            iRODS collection where the files should be put.
+        files : `list`
+            Full paths of the files in the local filesystem.
+        rule_path : `str`
+            Full path of the bundle extraction rule, see
+            rules/eudatBundleIngest.r.
+        purge_cache : `bool`, optional
+            Whether or not to trim the replicas in the cache resource of
+            compResc, as `doPut` does (default True).
+        register_checksum : `bool`, optional
+            Whether or not to register the SHA256 checksum in iRODS along
+            the data objects (default False).
+
+        Returns
+        -------
+        `list`
+            Names of the data objects created from the bundle.
+        """
+
+        self._irodsConnect()
+        self._checkCollExist(collname)
+
+        # Only bundle the files not yet in irods
+        objects = self.getCollectionObjects(collname)
+        files = [file for file in files if os.path.basename(file) not in objects]
+        if len(files) < 2:
+            return []
+
+        names = [os.path.basename(file) for file in files]
+        bundle_path = '{collname}/.bundle-{pid}-{stamp}.tar'.format(pid=os.getpid(), stamp=int(time.time() * 1000), **locals())
+
+        cache = self._getCacheResource("compResc") if purge_cache else None
+
+        # load rule from file
+        rule_total = self.load_rule(rule_path,
+                                    bundle='"{bundle_path}"'.format(**locals()),
+                                    coll='"{collname}"'.format(**locals()),
+                                    resc='"compResc"',
+                                    names='"{}"'.format('/'.join(names)),
+                                    checksum='"true"' if register_checksum else '"false"',
+                                    cache='"{}"'.format(cache or ''))
+
+        start = time.time()
+        with tempfile.NamedTemporaryFile(suffix='.tar') as bundle:
+            with tarfile.open(fileobj=bundle, mode='w') as tar:
+                for file, name in zip(files, names):
+                    tar.add(file, arcname=name)
+            bundle.flush()
+
+            try:
+                self.session.data_objects.put(bundle.name, bundle_path, **{kw.RESC_NAME_KW: "compResc"})
+                Rule(self.session,
+                     body=rule_total['body'],
+                     params=rule_total['params'],
+                     output=rule_total['output']).execute()
+            finally:
+                self.collectionObjects.pop(collname, None)
+                try:
+                    self.session.data_objects.unlink(bundle_path, force=True)
+                except Exception as ex:
+                    self.log.error("Could not remove bundle " + bundle_path)
+                    self.log.error(ex)
+
+        # Keep the data objects identical to the ones of a put
+        replicas = collections.defaultdict(list)
+        query = self.session.query(DataObject.name, DataObject.size, DataObject.checksum).filter(
+            Collection.name == collname).filter(In(DataObject.name, names))
+        for batch in query.get_batches():
+            for result in batch:
+                replicas[result[DataObject.name]].append((result[DataObject.size], result[DataObject.checksum]))
+
+        objects = self.getCollectionObjects(collname)
+        created = []
+        for file, name in zip(files, names):
+            if name not in replicas:
+                self.log.error("File not extracted from bundle: " + name)
+                continue
+            expected = (os.path.getsize(file), "sha2:" + checksums.sha256(file) if register_checksum else None)
+            if any(size != expected[0] or (register_checksum and checksum != expected[1]) for size, checksum in replicas[name]):
+                self.log.error("Size or checksum mismatch after bundle extraction, removing: " + name)
+                self.session.data_objects.unlink('{collname}/{name}'.format(**locals()), force=True)
+                objects.pop(name, None)
+                continue
+            created.append(name)
+
+        self.log.info("Bundled %d/%d file(s) into %s in %.2f s" %
+                      (len(created), len(files), collname, time.time() - start))
+
+        return created
+
+
+    def _getCacheResource(self, resc):
+        """Returns the name of the cache resource of a compound resource,
+        or None if it has none.
+
+        Parameters
+        ----------
+        resc : `str`
+            Name of the compound resource.
+        """
+
+        if resc not in self.cacheResources:
+            self._irodsConnect()
+            parent = self.session.query(Resource.id).filter(Resource.name == resc).one()
+            query = self.session.query(Resource.name).filter(
+                Resource.parent == str(parent[Resource.id])).filter(Resource.parent_context == 'cache')
+            results = [result[Resource.name] for result in query]
+            self.cacheResources[resc] = results[0] if results else None
+
+        return self.cacheResources[resc]
 
 
     def purgeTempFile(self, dirname, collname, filename, n_days,
@@ -179,6 +462,9 @@ class irodsDAO():
         """Delete file if it was created more than n_days ago and,
         optionally, if it is already registered in iRODS.
 
+        Files under a prefix of IRODS.VAULT_MAP are never deleted: they are
+        registered in place, so the file is the data object's only copy.
+
         Parameters
         ----------
         dirname : `str`
@@ -200,6 +486,10 @@ class irodsDAO():
         self.log.info("check obj_file : "+obj_file)
         self.log.info("check obj_path : "+obj_path)
 
+        if self.getVaultPath(obj_file) is not None:
+            self.log.info("File registered in place. Purge canceled.")
+            return
+
         limit_time = datetime.datetime.now() - datetime.timedelta(days=n_days)
         creation_time = datetime.datetime.fromtimestamp(os.path.getctime(obj_file))
         if creation_time >= limit_time:
@@ -209,14 +499,77 @@ class irodsDAO():
             self._irodsConnect()
 
             # Check whether the file is already in irods
-            query = self.session.query(DataObject.name).filter(DataObject.name == filename)
-            if len(query.execute()) == 0:
+            if filename not in self.getCollectionObjects(collname):
                 self.log.info("File not in iRODS. Purge canceled.")
                 return
 
         os.remove(os.path.join(obj_file))
         self.log.info('removed {}'.format(obj_file))
 
+    def getCollectionObjects(self, collname):
+        """Returns the data objects of a collection with their checksums.
+
+        All the data objects of the collection are loaded with a single
+        paged GenQuery the first time the collection is requested, and
+        kept for the session.
+
+        Parameters
+        ----------
+        collname : `str`
+            Name of collection.
+
+        Returns
+        -------
+        `dict`
+            The checksums (`set` of `str`, one per replica, None when not
+            registered) by data object name.
+        """
+
+        if collname in self.collectionObjects:
+            return self.collectionObjects[collname]
+
+        self._irodsConnect()
+
+        objects = {}
+        query = self.session.query(DataObject.name, DataObject.checksum).filter(Collection.name == collname)
+        for batch in query.get_batches():
+            for result in batch:
+                objects.setdefault(result[DataObject.name], set()).add(result[DataObject.checksum])
+
+        self.log.info("Found %d data object(s) in collection %s" % (len(objects), collname))
+        self.collectionObjects[collname] = objects
+
+        return objects
+
+    def getCollectionAVUs(self, collname, attributes):
+        """Returns the given metadata attributes of the data objects of a
+        collection, with a single paged GenQuery.
+
+        Parameters
+        ----------
+        collname : `str`
+            Name of collection.
+        attributes : `list`
+            Names of the metadata attributes.
+
+        Returns
+        -------
+        `dict`
+            The {attribute: value} metadata by data object name. Data
+            objects without any of the attributes are missing.
+        """
+
+        self._irodsConnect()
+
+        avus = {}
+        query = self.session.query(DataObject.name, DataObjectMeta.name, DataObjectMeta.value).filter(
+            Collection.name == collname).filter(In(DataObjectMeta.name, list(attributes)))
+        for batch in query.get_batches():
+            for result in batch:
+                avus.setdefault(result[DataObject.name], {})[result[DataObjectMeta.name]] = result[DataObjectMeta.value]
+
+        return avus
+
     def _ruleExec(self, rule_file_path):
         """Reads and runs a parameterless rule from a file.
 
@@ -237,7 +590,8 @@ class irodsDAO():
 
     def _checkCollExist(self, collname):
         """Creates a collection in the archive, recursively. Does nothing if
-        already present.
+        already present. Collections created in the current session are
+        cached and not created again, unless an operation on them failed.
 
         Parameters
         ----------
@@ -245,6 +599,9 @@ class irodsDAO():
             Name of collection.
         """
 
+        if collname in self.collections:
+            return
+
         self.log.info("check or create a collection recursively : "+collname)
         try:
             self.session.collections.create(collname, recurse=True)
@@ -252,7 +609,12 @@ class irodsDAO():
         except Exception as ex:
             self.log.error("Could not create a collection recursively ")
             self.log.error(ex)
-            pass
+            return
+
+        # the parents were created as well
+        while collname and collname != '/' and collname not in self.collections:
+            self.collections.add(collname)
+            collname = os.path.dirname(collname)
 
 
     def getObject(self, obj_path):
@@ -296,11 +658,55 @@ class irodsDAO():
         except Exception as ex:
             self.log.info("Could not execute a rule for PID ")
             self.log.info(ex)
-            pass        
+            return 0
 
         return 1 #returnedMeta 
 
 
+    #
+    # irods Rule Execution: PID creation of many objects in one rule call (PID)
+    # the rule gets the comma separated object paths in *paths and writes a
+    # "<object path> <pid>" line to stdout for each PID created or found
+    # returns {object path: pid}, objects without PID are missing
+    #
+    def rulePIDbatch(self, object_paths, rule_path):
+
+        # check connection
+        self._irodsConnect()
+
+        self.log.info("exec PID BATCH rule inside irods for %d object(s)" % len(object_paths))
+
+        # load rule from file
+        rule_total = self.load_rule(rule_path, paths='"{}"'.format(','.join(object_paths)))
+
+        # prep  rule
+        myrule = Rule(self.session,
+                      body=rule_total['body'],
+                      params=rule_total['params'],
+                      output=rule_total['output'] )
+
+        pids = {}
+
+        # exec rule
+        try:
+            out = myrule.execute()
+            stdout = out.MsParam_PI[0].inOutStruct.stdoutBuf.buf
+        except Exception as ex:
+            self.log.info("Could not execute a rule for PID BATCH ")
+            self.log.info(ex)
+            return pids
+
+        if isinstance(stdout, bytes):
+            stdout = stdout.decode(errors='replace')
+
+        for line in stdout.rstrip('\x00').splitlines():
+            fields = line.split()
+            if len(fields) == 2 and fields[0] in object_paths:
+                pids[fields[0]] = fields[1]
+
+        return pids
+
+
     #
     # irods Rule Execution: REPLICATION   (REP)
     #
@@ -331,11 +737,51 @@ class irodsDAO():
         except Exception as ex:
             self.log.info("Could not execute a rule for REPLICATION ")
             self.log.info(ex)
-            pass
+            return 0
 
         return 1 #returnedMeta  
 
 
+    #
+    # irods Rule Execution: REPLICATION of many objects in one rule call (REP)
+    # the rule gets the comma separated object paths in *sources and the target
+    # collection in *destination, and writes the path of each object replicated
+    # to stdout
+    # returns the set of the object paths replicated
+    #
+    def ruleReplicationBatch(self, object_paths, target_collection, rule_path):
+
+        # check connection
+        self._irodsConnect()
+
+        self.log.info("exec Replication BATCH rule inside irods for %d object(s)" % len(object_paths))
+
+        # load rule from file
+        rule_total = self.load_rule(rule_path,
+                                    sources='"{}"'.format(','.join(object_paths)),
+                                    destination='"{target_collection}"'.format(**locals()))
+
+        # prep  rule
+        myrule = Rule(self.session,
+                      body=rule_total['body'],
+                      params=rule_total['params'],
+                      output=rule_total['output'] )
+
+        # exec rule
+        try:
+            out = myrule.execute()
+            stdout = out.MsParam_PI[0].inOutStruct.stdoutBuf.buf
+        except Exception as ex:
+            self.log.info("Could not execute a rule for REPLICATION BATCH ")
+            self.log.info(ex)
+            return set()
+
+        if isinstance(stdout, bytes):
+            stdout = stdout.decode(errors='replace')
+
+        return set(line.strip() for line in stdout.rstrip('\x00').splitlines()) & set(object_paths)
+
+
     #
     # irods Rule Execution: REMOTE REPLICA REGISTRATION  (RRR)
     #
@@ -365,7 +811,7 @@ class irodsDAO():
         except Exception as ex:
             self.log.info("Could not execute a rule for REGISTRATION ")
             self.log.info(ex)
-            pass
+            return 0
 
         return 1 #returnedMeta  
 
@@ -389,7 +835,40 @@ class irodsDAO():
             - ``output``: The output line of the rule (`str`).
         """
 
+        template = self._getRuleTemplate(rule_file)
+
+        # put passed parameters in params            
+        params = dict(template.params)
+        for key, value in parameters.items():
+            params['*'+key] = value
+
         results = {}
+        results['params']=params
+        results['body']=template.body
+        results['output']=template.output
+
+        return results
+
+    def _getRuleTemplate(self, rule_file):
+        """Returns the parsed rule of a .r file, parsed again only when the
+        file modification time changes.
+
+        Parameters
+        ----------
+        rule_file : `str`
+            Full path of the file containing the rule.
+
+        Returns
+        -------
+        `RuleTemplate`
+            The rule's body, default INPUT parameters (read-only) and
+            OUTPUT line.
+        """
+
+        mtime = os.stat(rule_file).st_mtime_ns
+        if rule_file in self.rules and self.rules[rule_file][0] == mtime:
+            return self.rules[rule_file][1]
+
         params = {}
         output = ''
         body = '@external\n'
@@ -426,13 +905,9 @@ class irodsDAO():
                 else:
                     body += line
 
-        # put passed parameters in params            
-        for key, value in parameters.items():
-            params['*'+key] = value
-
-        results['params']=params
-        results['body']=body
-        results['output']=output
+        template = RuleTemplate(body, types.MappingProxyType(params), output)
+        self.rules[rule_file] = (mtime, template)
+        self.log.info("Loaded rule " + rule_file)
 
-        return results          
+        return template          
 
@@ -8,7 +8,22 @@
 import os
 import sys
 
-from pymongo import MongoClient
+from bson.objectid import ObjectId
+from pymongo import MongoClient, ASCENDING
+from pymongo.write_concern import WriteConcern
+from pymongo.errors import BulkWriteError, OperationFailure
+
+# number of values per $in query
+BATCH_SIZE = 1000
+
+# fields queried by the DAO, that must be indexed: (collection, field)
+INDEXED_FIELDS = [
+    ('daily_streams', 'fileId'),
+    ('daily_streams', 'files.name'),
+    ('wf_do', 'fileId'),
+    ('hourly_streams', 'streamId'),
+    ('c_segments', 'streamId')
+]
 
 #
 # data access object class for MongoDB
@@ -24,6 +39,7 @@ class MongoDAO():
         self.config = config
         self.host = self.config['MONGO']['DB_HOST']
         self._connected = False
+        self._transactions = None
     
     #
     # connect to MongoDB
@@ -41,6 +57,60 @@ class MongoDAO():
 
         self._connected = True
 
+        if self.config['MONGO']['ENSURE_INDEXES']:
+          self.ensureIndexes()
+
+    #
+    # creates the indexes of INDEXED_FIELDS, fileId of daily_streams
+    # is unique when ALLOW_DOUBLE is false
+    #
+    def ensureIndexes(self):
+
+        for collection, field in INDEXED_FIELDS:
+
+          unique = collection == 'daily_streams' and field == 'fileId' and not self.config['MONGO']['ALLOW_DOUBLE']
+
+          try:
+            name = self.db[collection].create_index([(field, ASCENDING)], unique=unique)
+            self.log.info("Index %s on %s is present" % (name, collection))
+          except OperationFailure as ex:
+            self.log.error("Could not create index on %s.%s" % (collection, field))
+            self.log.error(ex)
+
+    #
+    # warns for each query on INDEXED_FIELDS that would be a collection scan,
+    # run by --ensure-indexes after ensureIndexes
+    # only the query planner runs, the queries are not executed
+    #
+    def checkIndexes(self):
+
+        for collection, field in INDEXED_FIELDS:
+
+          try:
+            explain = self.db.command('explain', {'find': collection, 'filter': {field: ''}}, verbosity='queryPlanner')
+          except OperationFailure as ex:
+            self.log.error("Could not explain query on %s.%s" % (collection, field))
+            self.log.error(ex)
+            continue
+
+          if self._hasStage(explain['queryPlanner']['winningPlan'], 'COLLSCAN'):
+            self.log.warning("Query on %s.%s is a collection scan: index missing" % (collection, field))
+
+    #
+    # checks whether a query plan contains a stage
+    #
+    def _hasStage(self, plan, stage):
+
+        if isinstance(plan, dict):
+          if plan.get('stage') == stage:
+            return True
+          return any(self._hasStage(value, stage) for value in plan.values())
+
+        if isinstance(plan, list):
+          return any(self._hasStage(value, stage) for value in plan)
+
+        return False
+
     #
     # get wf_do FileDataObject
     #
@@ -78,17 +148,182 @@ class MongoDAO():
     #
     def removeDocumentsById(self, id):
        
-        self.db.daily_streams.remove({'_id': id})
-        self.db.hourly_streams.remove({'streamId': id})
-        self.db.c_segments.remove({'streamId': id})
+        self.removeDocumentsByIds([id])
+
+    #
+    # removes the daily streams with the given ObjectIds and their hourly streams
+    # and continuous segments, with delete_many in batches of BATCH_SIZE
+    # returns the number of removed daily streams
+    #
+    def removeDocumentsByIds(self, ids):
+
+        ids = list(set(ids))
+        removed = 0
+
+        for i in range(0, len(ids), BATCH_SIZE):
+            batch = ids[i:i + BATCH_SIZE]
+            removed += self.db.daily_streams.delete_many({'_id': {'$in': batch}}).deleted_count
+            self.db.hourly_streams.delete_many({'streamId': {'$in': batch}})
+            self.db.c_segments.delete_many({'streamId': {'$in': batch}})
+
+        return removed
+
+    #
+    # returns the ObjectIds of the daily streams of the given files
+    # queried in batches of BATCH_SIZE, projecting on _id only
+    #
+    def getDocumentIdsByFilenames(self, files):
+
+        fileIds = list(set(os.path.basename(file) for file in files))
+        ids = []
+
+        for i in range(0, len(fileIds), BATCH_SIZE):
+            cursor = self.db.daily_streams.find({'fileId': {'$in': fileIds[i:i + BATCH_SIZE]}}, {'_id': 1})
+            ids.extend(document['_id'] for document in cursor)
+
+        return ids
     
+    # 
+    # stores daily or hourly granules to collection in bulk, see insertMany
+    #
+    def _storeGranules(self, streams, granule):
+
+        if granule == 'daily':
+          return self.insertMany('daily_streams', streams)
+        elif granule == 'hourly':
+          return self.insertMany('hourly_streams', streams)
+
     # 
     # Saves a continuous segment to collection
     #
     def storeContinuousSegment(self, segment):
        
         self.db.c_segments.save(segment)
+
+    # 
+    # Saves continuous segments to collection in bulk, see insertMany
+    #
+    def storeContinuousSegments(self, segments):
+
+        return self.insertMany('c_segments', segments)
+
+    #
+    # inserts documents into a collection with a single insert_many
+    # ordered and write concern are taken from the MONGO configuration
+    # (BULK_ORDERED, WRITE_CONCERN) unless given
+    # returns the inserted ids and a dict {document index: error message}
+    # of the documents that were not inserted, or inserted without the
+    # requested write concern
+    #
+    def insertMany(self, collection, documents, ordered=None, writeConcern=None):
+
+        if not documents:
+          return [], {}
+
+        if ordered is None:
+          ordered = self.config['MONGO']['BULK_ORDERED']
+        if writeConcern is None:
+          writeConcern = self.config['MONGO']['WRITE_CONCERN']
+
+        coll = self.db.get_collection(collection, write_concern=WriteConcern(**writeConcern))
+
+        try:
+          result = coll.insert_many(documents, ordered=ordered)
+          return result.inserted_ids, {}
+        except BulkWriteError as ex:
+          errors = dict((error['index'], error['errmsg']) for error in ex.details['writeErrors'])
+
+          # an ordered insert stops at the first error
+          if ordered and errors:
+            for index in range(min(errors) + 1, len(documents)):
+              errors[index] = 'not inserted after a previous error'
+
+          # the other documents are written but the write concern is not satisfied
+          for error in ex.details['writeConcernErrors']:
+            for index in range(len(documents)):
+              errors.setdefault(index, 'write concern error: ' + error['errmsg'])
+
+          return [documents[i]['_id'] for i in range(len(documents)) if i not in errors], errors
     
+    #
+    # returns the ObjectId of the daily stream of a file, a new ObjectId
+    # if the file has no daily stream yet
+    #
+    def getStreamId(self, fileId):
+
+        document = self.db.daily_streams.find_one({'fileId': fileId}, {'_id': 1})
+
+        if document is None:
+          return ObjectId()
+
+        return document['_id']
+
+    #
+    # whether the server supports multi-document transactions:
+    # replica set member from MongoDB 4.0 (wire version 7) or mongos from 4.2 (wire version 8)
+    # ismaster is used as hello is missing before 4.4.2
+    #
+    def _supportsTransactions(self):
+
+        if self._transactions is None:
+          try:
+            ismaster = self.client.admin.command('ismaster')
+          except OperationFailure:
+            self._transactions = False
+            return False
+
+          wireVersion = ismaster.get('maxWireVersion', 0)
+          self._transactions = (('setName' in ismaster and wireVersion >= 7) or
+                                (ismaster.get('msg') == 'isdbgrid' and wireVersion >= 8))
+
+        return self._transactions
+
+    #
+    # replaces the daily stream of a file in place under the same _id, keyed on fileId,
+    # and swaps its hourly streams and continuous segments in bulk
+    # other daily streams of the file (ALLOW_DOUBLE) are removed
+    # the swap is atomic only on a replica set or sharded cluster, where all writes
+    # run in one transaction. on a standalone server the new children are inserted
+    # before the daily stream is replaced and the old children are removed last:
+    # a stream is never missing from the catalog, but readers can see both the old
+    # and the new hourly streams and continuous segments for a short time
+    #
+    def replaceStream(self, id, daily, hourly, segments):
+
+        daily['_id'] = id
+
+        if self._supportsTransactions():
+          with self.client.start_session() as session:
+            session.with_transaction(lambda session: self._replaceStream(id, daily, hourly, segments, session))
+        else:
+          self._replaceStream(id, daily, hourly, segments)
+
+        return id
+
+    def _replaceStream(self, id, daily, hourly, segments, session=None):
+
+        oldHourly = [document['_id'] for document in self.db.hourly_streams.find({'streamId': id}, {'_id': 1}, session=session)]
+        oldSegments = [document['_id'] for document in self.db.c_segments.find({'streamId': id}, {'_id': 1}, session=session)]
+        doubles = [document['_id'] for document in self.db.daily_streams.find({'fileId': daily['fileId'], '_id': {'$ne': id}}, {'_id': 1}, session=session)]
+
+        if hourly:
+          self.db.hourly_streams.insert_many(hourly, session=session)
+        if segments:
+          self.db.c_segments.insert_many(segments, session=session)
+
+        self.db.daily_streams.replace_one({'_id': id}, daily, upsert=True, session=session)
+
+        for i in range(0, len(oldHourly), BATCH_SIZE):
+          self.db.hourly_streams.delete_many({'_id': {'$in': oldHourly[i:i + BATCH_SIZE]}}, session=session)
+        for i in range(0, len(oldSegments), BATCH_SIZE):
+          self.db.c_segments.delete_many({'_id': {'$in': oldSegments[i:i + BATCH_SIZE]}}, session=session)
+
+        for i in range(0, len(doubles), BATCH_SIZE):
+          batch = doubles[i:i + BATCH_SIZE]
+          self.db.daily_streams.delete_many({'_id': {'$in': batch}}, session=session)
+          self.db.hourly_streams.delete_many({'streamId': {'$in': batch}}, session=session)
+          self.db.c_segments.delete_many({'streamId': {'$in': batch}}, session=session)
+
     # 
     # returns all documents that include this file in the metadata calculation
     #
@@ -96,9 +331,41 @@ class MongoDAO():
         
         return self.db.daily_streams.find({'files.name': os.path.basename(file)}, {'files': 1, 'fileId': 1, '_id': 1})
 
+    #
+    # returns all documents that include any of the files in the metadata calculation
+    # queried in batches of BATCH_SIZE, projecting on fileId and the used file names and checksums
+    #
+    def getDailyFilesByNames(self, files):
+
+        names = list(set(os.path.basename(file) for file in files))
+        documents = {}
+
+        for i in range(0, len(names), BATCH_SIZE):
+            cursor = self.db.daily_streams.find({'files.name': {'$in': names[i:i + BATCH_SIZE]}},
+                                                {'files.name': 1, 'files.chksm': 1, 'fileId': 1, '_id': 1})
+            for document in cursor:
+                documents[document['_id']] = document
+
+        return list(documents.values())
+
     #
     # get a Document By Filename
     #
     def getDocumentByFilename(self, file):
         
         return self.db.daily_streams.find({'fileId': os.path.basename(file)})
+
+    #
+    # returns the set of fileIds, among the given files, that have a daily stream
+    # queried in batches of BATCH_SIZE, projecting on fileId only
+    #
+    def getExistingFileIds(self, files):
+
+        fileIds = list(set(os.path.basename(file) for file in files))
+        existing = set()
+
+        for i in range(0, len(fileIds), BATCH_SIZE):
+            cursor = self.db.daily_streams.find({'fileId': {'$in': fileIds[i:i + BATCH_SIZE]}}, {'fileId': 1, '_id': 0})
+            existing.update(document['fileId'] for document in cursor)
+
+        return existing
@@ -0,0 +1,15 @@
+eudatBundleIngest{
+    # Extracts a tar bundle into the data objects of a collection, then
+    # registers their checksums and trims their cache replicas if asked
+    msiTarFileExtract(*bundle, *coll, *resc, *status);
+    foreach (*name in split(*names, "/")) {
+        if (*checksum == "true") {
+            msiDataObjChksum("*coll/*name", "forceChksum=", *chksum);
+        }
+        if (*cache != "") {
+            msiDataObjTrim("*coll/*name", *cache, "null", "1", "null", *trimmed);
+        }
+    }
+}
+INPUT *bundle='',*coll='',*resc='compResc',*names='',*checksum='false',*cache=''
+OUTPUT ruleExecOut
@@ -0,0 +1,20 @@
+eudatPidBatch{
+    # Makes the PIDs of many data objects in one call, keeping the existing
+    # ones, and writes a "<object path> <pid>" line to stdout for each
+    foreach (*path in split(*paths, ",")) {
+        *pid = "";
+        if (errorcode(EUDATSearchPID(*path, *pid)) < 0) {
+            *pid = "";
+        }
+        if (*pid == "" || *pid == "empty" || *pid == "None") {
+            if (errorcode(EUDATCreatePID("None", *path, "None", "None", "true", *pid)) < 0) {
+                *pid = "";
+            }
+        }
+        if (*pid != "" && *pid != "empty" && *pid != "None") {
+            writeLine("stdout", "*path *pid");
+        }
+    }
+}
+INPUT *paths=''
+OUTPUT ruleExecOut
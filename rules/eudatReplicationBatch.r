@@ -0,0 +1,14 @@
+eudatReplicationBatch{
+    # Replicates many data objects of a collection into the target
+    # collection in one call, and writes the path of each object
+    # replicated to stdout
+    foreach (*source in split(*sources, ",")) {
+        msiSplitPath(*source, *coll, *name);
+        *status = EUDATReplication(*source, "*destination/*name", "false", "false", *response);
+        if (*status) {
+            writeLine("stdout", *source);
+        }
+    }
+}
+INPUT *sources='',*destination=''
+OUTPUT ruleExecOut
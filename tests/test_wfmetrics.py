@@ -0,0 +1,167 @@
+"""
+Checks the metrics of wfmetrics (computeGranules, getFlags) against the
+ObsPy implementations they mirror (MSEEDMetadata, get_flags) on generated
+day files, so a change of ObsPy does not silently change the values.
+
+  > python -m pytest tests
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from obspy import Stream, Trace, UTCDateTime
+from obspy.core.util import AttribDict
+from obspy.io.mseed.util import get_flags, set_flags_in_fixed_headers
+from obspy.signal.quality_control import MSEEDMetadata
+
+import wfmetrics
+
+DAY = UTCDateTime(2020, 1, 2)
+
+
+def makeTrace(start, end, tq=None):
+    """Returns a 1 Hz trace from start to end (exclusive)."""
+
+    npts = int(end - start)
+    data = np.random.RandomState(int(start.timestamp) % 1000).randint(-1000, 1000, npts).astype(np.int32)
+    trace = Trace(data=data, header={'network': 'NL', 'station': 'HGN', 'location': '02',
+                                     'channel': 'BHZ', 'sampling_rate': 1.0, 'starttime': start})
+    trace.stats.mseed = AttribDict({'dataquality': 'D'})
+    if tq is not None:
+        trace.stats.mseed.blkt1001 = AttribDict({'timing_quality': tq})
+
+    return trace
+
+
+def writeDay(path, traces):
+    """Writes the traces of a day file in records of 512 bytes."""
+
+    Stream(traces).write(path, format='MSEED', reclen=512, encoding='STEIM2')
+
+
+def compare(metrics, expected, path=''):
+    """Returns the keys of expected that differ in metrics."""
+
+    if isinstance(expected, dict):
+        names = set(expected) - set(['wfmetadata_id', 'warnings'])
+        if not isinstance(metrics, dict) or set(metrics) - set(['wfmetadata_id', 'warnings']) != names:
+            return [path]
+        return [key for name in sorted(names)
+                for key in compare(metrics[name], expected[name], path + '.' + name)]
+
+    if isinstance(expected, np.ndarray):
+        return [] if np.allclose(metrics, expected) else [path]
+
+    if isinstance(expected, float) and metrics is not None:
+        return [] if abs(metrics - expected) < 1e-6 else [path]
+
+    return [] if metrics == expected else [path]
+
+
+class TestMetricsParity(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+
+        cls.directory = tempfile.mkdtemp()
+        cls.files = [os.path.join(cls.directory, 'NL.HGN.02.BHZ.D.2020.%03d' % day) for day in (1, 2, 3)]
+
+        # Previous day runs into the day, the next day starts before it
+        writeDay(cls.files[0], [makeTrace(DAY - 86400, DAY + 600, tq=80)])
+        writeDay(cls.files[2], [makeTrace(DAY + 86400 - 600, DAY + 2 * 86400, tq=90)])
+
+        # Day with a gap and an overlap
+        writeDay(cls.files[1], [makeTrace(DAY, DAY + 5 * 3600, tq=100),
+                                makeTrace(DAY + 5.5 * 3600, DAY + 12 * 3600 + 60, tq=60),
+                                makeTrace(DAY + 12 * 3600, DAY + 86400, tq=100)])
+
+        set_flags_in_fixed_headers(cls.files[0], {'...': {'data_qual_flags': {'spikes_detected': True}}})
+        set_flags_in_fixed_headers(cls.files[1], {'...': {
+            'data_qual_flags': {'glitches_detected': {'DURATION': [(DAY + 8 * 3600, DAY + 9.5 * 3600)]}},
+            'activity_flags': {'calib_signal': True},
+            'io_clock_flags': {'clock_locked': {'DURATION': [(DAY + 14 * 3600, DAY + 15 * 3600)]}}
+        }})
+
+        cls.daily = {'start': DAY, 'end': DAY + 86400}
+        cls.hourly = [{'start': DAY + 3600 * i, 'end': DAY + 3600 * (i + 1)} for i in range(24)]
+
+    @classmethod
+    def tearDownClass(cls):
+
+        shutil.rmtree(cls.directory)
+
+    def setUp(self):
+
+        wfmetrics.traceCache.clear()
+
+    def _computeGranules(self):
+
+        return wfmetrics.computeGranules(self.files, self.daily, self.hourly, True, True,
+                                         neighbours=(self.files[0], self.files[2]))
+
+    def test_daily(self):
+
+        granules = self._computeGranules()
+        expected = MSEEDMetadata(self.files, starttime=self.daily['start'], endtime=self.daily['end'],
+                                 add_flags=True, add_c_segments=True).meta
+
+        self.assertEqual(compare(granules['daily'], expected), [])
+
+    def test_hourly(self):
+
+        granules = self._computeGranules()
+        self.assertEqual(granules['errors'], [])
+
+        hourly = dict((str(granule['start_time']), granule) for granule in granules['hourly'])
+        self.assertEqual(len(hourly), 24)
+
+        for window in self.hourly:
+            expected = MSEEDMetadata(self.files, starttime=window['start'], endtime=window['end'],
+                                     add_flags=True, add_c_segments=False).meta
+            self.assertEqual(compare(hourly[str(expected['start_time'])], expected), [], window['start'])
+
+    def test_cached(self):
+
+        # Neighbours read entirely from the cache give the same granules
+        for file in self.files:
+            wfmetrics.traceCache.get(file)
+            wfmetrics.traceCache.getFlagRecords(file)
+
+        granules = self._computeGranules()
+        expected = MSEEDMetadata(self.files, starttime=self.daily['start'], endtime=self.daily['end'],
+                                 add_flags=True, add_c_segments=True).meta
+
+        self.assertEqual(compare(granules['daily'], expected), [])
+
+    def test_flags(self):
+
+        records = [wfmetrics.readFlagRecords(file) for file in self.files]
+
+        for window in [self.daily] + self.hourly:
+            expected = get_flags(self.files, starttime=window['start'], endtime=window['end'])
+            flags = wfmetrics.getFlags(records, window['start'], window['end'])
+            self.assertEqual(compare(flags, expected), [], window['start'])
+
+    def test_boundary_flags(self):
+
+        # Only the records around the window are scanned of the neighbours
+        full = wfmetrics.readFlagRecords(self.files[0])
+        boundary = wfmetrics.readFlagRecords(self.files[0], self.daily['start'], self.daily['end'])
+        self.assertLess(len(boundary), len(full))
+
+        records = [boundary, wfmetrics.readFlagRecords(self.files[1]),
+                   wfmetrics.readFlagRecords(self.files[2], self.daily['start'], self.daily['end'])]
+        expected = get_flags(self.files, starttime=self.daily['start'], endtime=self.daily['end'])
+
+        self.assertEqual(compare(wfmetrics.getFlags(records, self.daily['start'], self.daily['end']), expected), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
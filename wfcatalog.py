@@ -12,20 +12,26 @@ import json
 import argparse
 import datetime
 import logging
-from logging.handlers import TimedRotatingFileHandler
+import collections
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from logging.handlers import TimedRotatingFileHandler, QueueHandler, QueueListener
 
 import wfcollector
 import wfsequencer
+from wfchecksum import checksums
 
 CONFIG_FILE = 'config.json'
 
 class main():
 
-    def __init__(self, parsedargs, config):
+    def __init__(self, parsedargs, config, logQueue=None):
 
         self.config = config
-        self._setupLogger(parsedargs['logfile'])
+        self._setupLogger(parsedargs['logfile'], logQueue)
         self.parsedargs = parsedargs 
+        self.datastations = None
+        self.fileIndex = None
 
         # mongo
         self.mongo = None
@@ -34,17 +40,20 @@ class main():
             self.mongo = mongomanager.MongoDAO(self.config, self.log)
 
 
-    def mainProcess(self):
+    def _setupServices(self):
+        """Connects to Mongo and sets up the collector, the iRODS session and
+        the Dublin Core processor used by the sequence."""
 
-        print ("START Main")      
-        timeInitialized = datetime.datetime.now()
+        # persistent checksums
+        if self.config['CHECKSUM_CACHE']['ENABLED']:
+            checksums.openStore(self.config['CHECKSUM_CACHE']['PATH'], bool(self.parsedargs.get('paranoid')))
 
         # connect to mongo DB
         if self.mongo:
             self.mongo._connect()
 
         # WF Collector
-        self.WFcollector = wfcollector.WFCatalogCollector(self.parsedargs, self.config, self.mongo, self.log)
+        self.WFcollector = wfcollector.WFCatalogCollector(self.parsedargs, self.config, self.mongo, self.log, self.fileIndex)
         print("WFcollector ")
 
         # iRODS
@@ -53,47 +62,307 @@ class main():
             import irodsmanager
             self.irods = irodsmanager.irodsDAO(self.config, self.log)
 
-        # file property      
-        digitObjProperty = {}
-
         # Dublin Core
         self.dublinCore = None
         if self.config['DUBLIN_CORE']['ENABLED']:
             import wfdublincore
             self.dublinCore = wfdublincore.dublinCore(self.config, self.log) 
 
-            # get stations informations via webservices
+
+    def mainProcess(self):
+
+        print ("START Main")      
+        timeInitialized = datetime.datetime.now()
+
+        # only create the database indexes
+        if self.parsedargs.get('ensure_indexes'):
+            self._ensureIndexes()
+            return
+
+        # index of processed files
+        if self.config['FILE_INDEX']['ENABLED']:
+            import wfindex
+            self.fileIndex = wfindex.FileIndex(self.config['FILE_INDEX']['PATH'], self.log)
+
+        self._setupServices()
+
+        # only rebuild the index of processed files
+        if self.parsedargs.get('rebuild_index'):
+            self._rebuildIndex()
+            return
+
+        # only remove the documents of the files, no rules are applied
+        if self.parsedargs.get('delete'):
+            self._deleteDocuments()
+            return
+
+        # get stations informations via webservices
+        if self.dublinCore:
             print("get datastations")        
-            digitObjProperty["datastations"] = self.dublinCore.getDataStations()
+            self.datastations = self.dublinCore.getDataStations()
+
+        # only check the replicas of the files
+        if self.parsedargs.get('reconcile_replicas'):
+            self._reconcileReplicas()
+            return
+
+        # keep running on the files written in the archive
+        if self.parsedargs.get('watch'):
+            self.watchProcess()
+            return
 
         # get *unfiltered* DigitalObject list to process
         print("get FileList") 
         files = self.WFcollector.getFileList(filter=False)
+
         # set sequencer 
         sequencer = wfsequencer.sequencer(self.config, self.log, self.irods, self.mongo, self.WFcollector, self.dublinCore)
 
+        # put the small files in bundles first
+        sequencer.bundlePut([self.getDigitObjProperty(file) for file in files])
+
         # apply rules on each file
-        for file in files:
+        workers = int(self.parsedargs.get('workers') or 1)
+        try:
+            if workers > 1:
+                summary = self._runParallel(files, workers) + sequencer.summary
+            else:
+                for file in files:
+                    sequencer.doSequence(self.getDigitObjProperty(file))
+                    self._markProcessed(sequencer.popFinished())
+                sequencer.close()
+                self._markProcessed(sequencer.popFinished())
+                summary = sequencer.summary
+
+        # keep the files processed so far
+        finally:
+            if self.fileIndex:
+                self.fileIndex.close()
+
+        print ("END Main ")
 
-            # Digital Object Property extraction            
-            dirname, filename = os.path.split(file)
-            digitObjProperty["file"] = file
-            digitObjProperty["start_time"] = self.WFcollector._getDateFromFile(file)
-            collname = self.irodsPath(file, self.config['IRODS']['BASE_PATH'])
-            colltarget = self.irodsPath(file, self.config['IRODS']['REMOTE_PATH'])
-            digitObjProperty["dirname"] = dirname
-            digitObjProperty["filename"] = filename
-            digitObjProperty["collname"] = collname
-            digitObjProperty["object_path"] = '{collname}/{filename}'.format(**locals())
-            digitObjProperty["target_path"] = '{colltarget}/{filename}'.format(**locals())
+        self._logSummary(summary, len(files))
+        self.log.info(" ** Sequence is done, collector synchronization completed in %s." % (datetime.datetime.now() - timeInitialized))
 
-            # run rules sequence 
-            sequencer.doSequence(digitObjProperty)
 
+    def _deleteDocuments(self):
+        """Removes the documents of the selected files from the database in
+        bulk, without computing any metrics."""
 
-        print ("END Main ")
+        if not self.mongo:
+            raise Exception("Cannot delete documents when database connection is disabled")
 
-        self.log.info(" ** Sequence is done, collector synchronization completed in %s." % (datetime.datetime.now() - timeInitialized))
+        files = self.WFcollector.getFileList()
+        self.WFcollector.removeDocuments(files)
+
+        if self.fileIndex:
+            self.fileIndex.forget(files)
+            self.fileIndex.close()
+
+
+    def _reconcileReplicas(self):
+        """Checks that the objects of the selected files are replicated, and
+        replicates again the ones that are not."""
+
+        if not self.irods:
+            raise Exception("Cannot check replicas when iRODS is disabled")
+
+        files = self.WFcollector.getFileList(filter=False)
+
+        sequencer = wfsequencer.sequencer(self.config, self.log, self.irods, self.mongo, self.WFcollector, self.dublinCore)
+        sequencer.reconcileReplicas([self.getDigitObjProperty(file) for file in files])
+        sequencer.close()
+
+        self._logSummary(sequencer.summary, len(files))
+
+
+    def _ensureIndexes(self):
+        """Creates the indexes of the WFCatalog collections and checks the
+        query plans."""
+
+        if not self.mongo:
+            raise Exception("Cannot create indexes when database connection is disabled")
+
+        # indexes are already created on connection when ENSURE_INDEXES is set
+        self.mongo._connect()
+        if not self.config['MONGO']['ENSURE_INDEXES']:
+            self.mongo.ensureIndexes()
+
+        # query plans are only checked here, once the indexes exist
+        self.mongo.checkIndexes()
+
+
+    def watchProcess(self):
+        """Applies the rule sequence to the archive files as soon as they are
+        settled and their day is over, until interrupted. The documents of
+        the files already processed are replaced, as with --update. The
+        iRODS session and the Mongo client are kept open between files. See
+        `wfwatcher.ArchiveWatcher`."""
+
+        import wfwatcher
+
+        # no file list is collected in watch mode
+        self.WFcollector._setOptions()
+        self.WFcollector.file_counter = 0
+        self.WFcollector.totalFiles = 0
+
+        # late data changes the files already processed
+        self.WFcollector.args['update'] = True
+
+        sequencer = wfsequencer.sequencer(self.config, self.log, self.irods, self.mongo, self.WFcollector, self.dublinCore)
+        watcher = wfwatcher.ArchiveWatcher(self.config, self.log, self.WFcollector)
+
+        self.log.info("Watching archive %s for new files" % self.config['ARCHIVE_ROOT'])
+
+        try:
+            for files in watcher.settledFiles():
+                self.log.info("Processing %d settled file(s)" % len(files))
+                self.WFcollector.totalFiles += len(files)
+
+                sequencer.bundlePut([self.getDigitObjProperty(file) for file in files])
+                for file in files:
+                    sequencer.doSequence(self.getDigitObjProperty(file))
+                    self._markProcessed(sequencer.popFinished())
+                sequencer.flush()
+                self._markProcessed(sequencer.popFinished())
+
+                if self.fileIndex:
+                    self.fileIndex.flush()
+
+        except KeyboardInterrupt:
+            self.log.info("Watch interrupted")
+
+        finally:
+            sequencer.close()
+            if self.fileIndex:
+                self.fileIndex.close()
+            self._logSummary(sequencer.summary, self.WFcollector.totalFiles)
+
+
+    def getDigitObjProperty(self, file):
+        """Returns a new property dictionary of the digital object for the
+        given file. See `wfsequencer.sequencer` for its keys.
+
+        Parameters
+        ----------
+        file : `str`
+            Full file path.
+        """
+
+        digitObjProperty = {}
+
+        # Digital Object Property extraction            
+        dirname, filename = os.path.split(file)
+        collname = self.irodsPath(file, self.config['IRODS']['BASE_PATH'])
+        colltarget = self.irodsPath(file, self.config['IRODS']['REMOTE_PATH'])
+        digitObjProperty["file"] = file
+        digitObjProperty["start_time"] = self.WFcollector._getDateFromFile(file)
+        digitObjProperty["dirname"] = dirname
+        digitObjProperty["filename"] = filename
+        digitObjProperty["collname"] = collname
+        digitObjProperty["object_path"] = '{collname}/{filename}'.format(**locals())
+        digitObjProperty["target_path"] = '{colltarget}/{filename}'.format(**locals())
+        if self.datastations is not None:
+            digitObjProperty["datastations"] = self.datastations
+
+        return digitObjProperty
+
+
+    def _runParallel(self, files, workers):
+        """Applies the rule sequence to the files in a pool of worker processes.
+
+        Every worker opens its own iRODS session, Mongo client, collector
+        and sequencer. Log records of the workers are sent back through a
+        queue and written by the log handler of this process.
+
+        Parameters
+        ----------
+        files : `list`
+            Full paths of the files to process.
+        workers : `int`
+            Number of worker processes.
+
+        Returns
+        -------
+        `collections.Counter`
+            The merged sequence summary of all workers.
+        """
+
+        self.log.info("Applying sequence on %d file(s) with %d workers" % (len(files), workers))
+
+        logQueue = multiprocessing.Queue()
+        listener = QueueListener(logQueue, *self.log.handlers)
+        listener.start()
+
+        summary = collections.Counter()
+        try:
+            with ProcessPoolExecutor(max_workers=workers,
+                                     initializer=_initWorker,
+                                     initargs=(self.parsedargs, self.config, logQueue,
+                                               self.datastations, len(files))) as pool:
+
+                # keep consecutive files on the same worker
+                chunksize = max(1, len(files) // (4 * workers))
+                chunks = [files[i:i + chunksize] for i in range(0, len(files), chunksize)]
+                for chunkSummary, finished in pool.map(_runWorker, chunks):
+                    summary.update(chunkSummary)
+                    self._markProcessed(finished)
+        finally:
+            listener.stop()
+
+        return summary
+
+
+    def _markProcessed(self, finished):
+        """Records the finished files in the index of processed files,
+        except the ones on which a rule failed or timed out.
+
+        Parameters
+        ----------
+        finished : `list`
+            The (file, ok) pairs given by `wfsequencer.sequencer.popFinished`.
+        """
+
+        if not self.fileIndex:
+            return
+
+        for file, ok in finished:
+            if ok:
+                self.fileIndex.markProcessed(file)
+
+
+    def _rebuildIndex(self):
+        """Rebuilds the index of processed files from the archive. When the
+        database is enabled, only files with a daily stream are indexed."""
+
+        if not self.fileIndex:
+            raise Exception("Cannot rebuild the file index when it is disabled")
+
+        files = list(self.WFcollector._scanFiles(self.config['ARCHIVE_ROOT']))
+        self.log.info("Found %d file(s) in the archive" % len(files))
+
+        if self.mongo:
+            existing = self.mongo.getExistingFileIds(files)
+            files = [file for file in files if os.path.basename(file) in existing]
+
+        self.fileIndex.rebuild(files)
+        self.fileIndex.close()
+
+
+    def _logSummary(self, summary, nFiles):
+        """Logs the outcome of the rule sequence for the processed files.
+
+        Parameters
+        ----------
+        summary : `collections.Counter`
+            Counts of outcomes, keyed by '<step> <outcome>'.
+        nFiles : `int`
+            Number of files given to the sequence.
+        """
+
+        self.log.info(" ** Sequence summary for %d file(s):" % nFiles)
+        for key in sorted(summary):
+            self.log.info("    %s: %d" % (key, summary[key]))
 
 
     def irodsPath(self, file, irodsPathBase):
@@ -118,28 +387,67 @@ class main():
 
         return irodsPath
 
-    def _setupLogger(self, logfile):
+    def _setupLogger(self, logfile, logQueue=None):
         """Initializes the logger.
 
         Parameters
         ----------
         logfile : str
             The name of the logfile.
+        logQueue : `multiprocessing.Queue`, optional
+            When given, log records are sent to this queue instead of
+            the logfile (worker processes).
         """
 
         # Set up WFCatalogger
         self.log = logging.getLogger('WFCatalog Collector')
 
-        log_file = logfile or config['DEFAULT_LOG_FILE']
+        log_file = logfile or self.config['DEFAULT_LOG_FILE']
 
         # Set Level
         self.log.setLevel('INFO')
 
+        if logQueue is not None:
+            # drop the handlers inherited from the parent process
+            for handler in list(self.log.handlers):
+                self.log.removeHandler(handler)
+            self.log.addHandler(QueueHandler(logQueue))
+            return
+
         self.file_handler = TimedRotatingFileHandler(log_file, when="midnight")
         self.file_handler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(name)s: %(message)s"))
         self.log.addHandler(self.file_handler)
 
 
+# worker process state, see main._runParallel
+worker = None
+
+def _initWorker(parsedargs, config, logQueue, datastations, totalFiles):
+    """Sets up the services and the sequencer of a worker process."""
+
+    global worker
+    worker = main(parsedargs, config, logQueue)
+    worker._setupServices()
+    worker.datastations = datastations
+
+    # the file list is collected by the parent process
+    worker.WFcollector._setOptions()
+    worker.WFcollector.file_counter = 0
+    worker.WFcollector.totalFiles = totalFiles
+
+    worker.sequencer = wfsequencer.sequencer(config, worker.log, worker.irods, worker.mongo, worker.WFcollector, worker.dublinCore)
+
+def _runWorker(files):
+    """Runs the rule sequence on consecutive files inside a worker process,
+    then the deferred PIDs and replications. Returns the summary of the
+    files and their (file, ok) pairs, see `wfsequencer.sequencer.popFinished`."""
+
+    before = collections.Counter(worker.sequencer.summary)
+    for file in files:
+        worker.sequencer.doSequence(worker.getDigitObjProperty(file))
+    worker.sequencer.close()
+
+    return worker.sequencer.summary - before, worker.sequencer.popFinished()
 
 
 
@@ -161,6 +469,7 @@ if __name__ == '__main__':
     parser.add_argument('--past', help='process files in a specific range in the past', choices=['day', 'yesterday', 'week', 'fortnight', 'month'], default=None)
     parser.add_argument('--date', help='process files for a specific date', default=None)
     parser.add_argument('--range', help='number of days after a specific date', default=1)
+    parser.add_argument('--watch', help='keep running and process files as they are written in the archive', action='store_true')
 
     # Options to show config/versioning
     parser.add_argument('--config', help='view configuration options', action='store_true')
@@ -177,11 +486,24 @@ if __name__ == '__main__':
     # Set custom rule map
     parser.add_argument('--rulemap', help='set custom rule map file')
 
+    # Check the replicas of the files, replicate again the missing ones and exit
+    parser.add_argument('--reconcile-replicas', help='check the replicas of the files and replicate again the missing ones', action='store_true')
+
+    # Rebuild the index of processed files from the archive and exit
+    parser.add_argument('--rebuild-index', help='rebuild the index of processed files and exit', action='store_true')
+
+    # Create the indexes of the database collections and exit
+    parser.add_argument('--ensure-indexes', help='create the database indexes and exit', action='store_true')
+
+    # Number of worker processes applying the sequence
+    parser.add_argument('--workers', help='number of worker processes applying the sequence in parallel', type=int, default=1)
+
     # Options to update documents existing in the database, normally
     # files that are already processed are skipped
     # Updates can be forced (without checksum check)
     parser.add_argument('--update', help='update existing documents in the database', action='store_true')
     parser.add_argument('--force', help='force file updates', action='store_true')
+    parser.add_argument('--paranoid', help='rehash files ignoring the persistent checksum cache', action='store_true')
     parser.add_argument('--delete', help='delete files from database', action='store_true')
 
     # Option for Catalog DublinCore dc_on 
@@ -196,9 +518,9 @@ if __name__ == '__main__':
         config['RULEMAP_FILE'] = parsedargs['rulemap']
 
     ## wake-up
-    main = main(parsedargs, config)
+    wfcatalog = main(parsedargs, config)
     
     ## rock-n-roll
-    main.mainProcess() 
+    wfcatalog.mainProcess() 
     
     
@@ -0,0 +1,169 @@
+#! /usr/bin/env python
+"""
+#
+#
+#
+
+"""
+
+import os
+import mmap
+import base64
+import sqlite3
+import hashlib
+import threading
+import collections
+
+# bytes hashed per update
+BLOCKSIZE = 1 << 20
+
+# files whose checksums are memoised in memory
+MEMO_SIZE = 1024
+
+
+class ChecksumService():
+    """Computes the MD5 and SHA256 checksums of a file in a single read.
+
+    Results are memoised per file and reused as long as the file size and
+    modification time do not change, so a file used by several granules,
+    or by both the collector and the iRODS ingestion, is read only once.
+    The memo keeps the ``maxsize`` most recently used files, so it does
+    not grow in long running (``--watch``) processes.
+
+    With a persistent store (see `openStore`), checksums are also kept
+    across runs, keyed on the file identity (device, inode, size, mtime_ns),
+    so unchanged files are not hashed again. Setting ``paranoid`` ignores
+    the stored checksums and rehashes every file once per run.
+    """
+
+    def __init__(self, maxsize=MEMO_SIZE):
+
+        self.maxsize = maxsize
+        self.digests = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.storePath = None
+        self.conn = None
+        self.pid = None
+        self.paranoid = False
+
+    def openStore(self, path, paranoid=False):
+        """Uses a persistent SQLite store of checksums.
+
+        Parameters
+        ----------
+        path : `str`
+            Path of the SQLite database file.
+        paranoid : `bool`, optional
+            Whether to ignore the stored checksums (default False).
+        """
+
+        self.storePath = path
+        self.paranoid = paranoid
+        self.conn = None
+
+    def _getStore(self):
+        """Returns the connection to the store of this process, opening it
+        if needed (connections are not shared with forked workers)."""
+
+        if self.storePath is None:
+            return None
+
+        if self.conn is None or self.pid != os.getpid():
+            self.conn = sqlite3.connect(self.storePath, timeout=60, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS checksums ("
+                              "dev INTEGER, inode INTEGER, size INTEGER, mtime_ns INTEGER, "
+                              "md5 TEXT, sha256 TEXT, "
+                              "PRIMARY KEY (dev, inode, size, mtime_ns))")
+            self.conn.commit()
+            self.pid = os.getpid()
+
+        return self.conn
+
+    def getDigests(self, file):
+        """Returns the checksums of a file.
+
+        Parameters
+        ----------
+        file : `str`
+            Full file path.
+
+        Returns
+        -------
+        `dict`
+            - ``md5``: Hexadecimal MD5 digest (`str`).
+            - ``sha256``: Base64 SHA256 digest, as registered by iRODS
+                          after the ``sha2:`` prefix (`str`).
+        """
+
+        stat = os.stat(file)
+        identity = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+        with self.lock:
+            if file in self.digests and self.digests[file][0] == identity:
+                self.digests.move_to_end(file)
+                return self.digests[file][1]
+
+            store = self._getStore()
+            if store is not None and not self.paranoid:
+                row = store.execute("SELECT md5, sha256 FROM checksums "
+                                    "WHERE dev = ? AND inode = ? AND size = ? AND mtime_ns = ?", identity).fetchone()
+                if row is not None:
+                    digests = {'md5': row[0], 'sha256': row[1]}
+                    self._memoise(file, identity, digests)
+                    return digests
+
+        md5 = hashlib.md5()
+        sha256 = hashlib.sha256()
+
+        with open(file, 'rb') as f:
+            if stat.st_size > 0:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    view = memoryview(mm)
+                    try:
+                        for offset in range(0, len(mm), BLOCKSIZE):
+                            block = view[offset:offset + BLOCKSIZE]
+                            md5.update(block)
+                            sha256.update(block)
+                            block.release()
+                    finally:
+                        view.release()
+
+        digests = {
+            'md5': md5.hexdigest(),
+            'sha256': base64.b64encode(sha256.digest()).decode()
+        }
+
+        with self.lock:
+            self._memoise(file, identity, digests)
+
+            store = self._getStore()
+            if store is not None:
+                store.execute("INSERT OR REPLACE INTO checksums (dev, inode, size, mtime_ns, md5, sha256) "
+                              "VALUES (?, ?, ?, ?, ?, ?)", identity + (digests['md5'], digests['sha256']))
+                store.commit()
+
+        return digests
+
+    def _memoise(self, file, identity, digests):
+        """Memoises the checksums of a file, evicting the least recently
+        used files (the lock must be held)."""
+
+        self.digests[file] = (identity, digests)
+        self.digests.move_to_end(file)
+        while len(self.digests) > self.maxsize:
+            self.digests.popitem(last=False)
+
+    def md5(self, file):
+        """Returns the hexadecimal MD5 digest of a file."""
+
+        return self.getDigests(file)['md5']
+
+    def sha256(self, file):
+        """Returns the base64 SHA256 digest of a file."""
+
+        return self.getDigests(file)['sha256']
+
+
+# Checksums of the running process, shared by the collector and iRODS
+checksums = ChecksumService()
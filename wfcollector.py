@@ -18,8 +18,23 @@ Authors:
     DB_HOST: Host of Mongo database.
     DB_NAME: Name of database.
     ALLOW_DOUBLE: (true | false) if true, can insert multiple documents withe same file ID (unique Net, Sta, Cha, Loc, Day)
+    BULK_ORDERED: (true | false) if true, a bulk insert of granules or segments stops at the first failing document
+    WRITE_CONCERN: Write concern options of bulk inserts (e.g. {"w": 1})
+    ENSURE_INDEXES: (true | false) if true, creates the indexes required by the collector when connecting
   ARCHIVE_ROOT: Root of the archive (e.g. "/path/to/archive/SDS/"). The following subdirectories are the archived years.
   DEFAULT_LOG_FILE: Path to log for writing.
+  WATCH:
+    SETTLE_SECONDS: Seconds without changes after which a written file is processed
+    POLL_INTERVAL: Seconds between scans of the files of today and yesterday, when inotify is not used
+    USE_INOTIFY: (true | false) use inotify (python package inotify_simple) instead of polling, not for NFS
+  CHECKSUM_CACHE:
+    ENABLED: (true | false) if true, checksums are stored across runs and unchanged files (same device, inode, size, mtime) are not hashed again
+    PATH: Path of the SQLite checksum store
+  FILE_INDEX:
+    ENABLED: (true | false) if true, only files new or changed since they were last processed are collected
+    PATH: Path of the SQLite index of processed files
+  PROCESSING_TIMEOUT: Seconds after which a metric calculation is killed and the file is reported as timed out.
+  TRACE_CACHE_SIZE: Number of decoded mSEED files kept in memory, so neighbouring day files are decoded once.
   FILTERS:
     WHITE: Array of strings used for fnmatch (default ["*"] for everything)
     BLACK: Array of strings used for fnmatch (has precedent over white list)
@@ -58,6 +73,7 @@ Authors:
   ### Boolean flags
   [--update] start synchronization on input files with changes
   [--force] forces synchronization on all input files 
+  [--paranoid] rehash all input files, ignoring the persistent checksum cache
   [--csegs] include continuous segments
   [--flags] include miniseed header percentages, timing correction, and timing quality
   [--hourly] include hourly granules
@@ -70,6 +86,7 @@ Authors:
   [--file $FILE] process a specific file
   [--list $ARRAY] Array of files to be processed
   [--past $ENUM] files in date range matching this criteria will be processed {today, yesterday, week, fortnight, month}
+  [--watch] keep running and process the archive files once they are written (see wfwatcher)
 
   ### Other flags
   [--logfile] specify a custom logfile
@@ -82,36 +99,33 @@ import json
 import logging
 import argparse
 import datetime
-import hashlib
-import warnings
 import sys
 import fnmatch
-import signal
 import glob
+import threading
 
-# ObsPy mSEED-QC is required
-try:
-    from obspy.signal.quality_control import MSEEDMetadata
-except ImportError as ex:
-    raise ImportError('Failure to load MSEEDMetadata; ObsPy mSEED-QC is required.')
+import wfmetrics
+from wfchecksum import checksums
 
 
 class WFCatalogCollector():
     """WFCatalogCollector class for ingesting waveform metadata."""
 
-    def __init__(self, parsedargs, config, mongo, log):
+    def __init__(self, parsedargs, config, mongo, log, fileIndex=None):
         """
         WFCatalogCollector.__init__
         > initialize the class, set up logger and database connection
+        > and the optional wfindex.FileIndex of processed files
         """
 
         self.parsedargs = parsedargs
         self.config = config
         self.mongo = mongo
         self.log = log
+        self.fileIndex = fileIndex
 
-    def handler(self, signum, frame):
-        raise Exception("Metric calculation has timed out")
+        # One metric computation process per thread
+        self._runners = threading.local()
 
     def _setOptions(self):
         """
@@ -130,6 +144,7 @@ class WFCatalogCollector():
             'list': None,
             'past': None,
             'date': None,
+            'watch': False,
             'csegs': False,
             'flags': False,
             'hourly': False,
@@ -155,8 +170,9 @@ class WFCatalogCollector():
             sys.exit(0)
 
         # Check if there is a single input method
-        nInput = 6 - [self.args['date'], self.args['file'], self.args['dir'],
-                      self.args['list'], self.args['past'], self.args['glob']].count(None)
+        nInput = 7 - [self.args['date'], self.args['file'], self.args['dir'],
+                      self.args['list'], self.args['past'], self.args['glob'],
+                      self.args['watch'] or None].count(None)
         if nInput == 0:
             raise Exception("No input was given")
         if nInput > 1:
@@ -180,9 +196,20 @@ class WFCatalogCollector():
         self._setOptions()
         self._getFiles()
 
+        # Keep the files new or changed since the last run
+        # (all the files are still listed and stat'ed)
+        if self.fileIndex is not None and not self.args['force'] and not self.args['delete']:
+            self.files = self.fileIndex.getChangedFiles(self.files)
+            self.totalFiles = len(self.files)
+            self.log.info("Kept %d new or changed file(s) since the last run" % self.totalFiles)
+
         if filter:
             self._filterFiles()
 
+        # Order the files per stream chronologically
+        # so the neighbouring day files are found in the trace cache
+        self.files = sorted(self.files, key=os.path.basename)
+
         return self.files
 
     def _passFilter(self, filename):
@@ -253,47 +280,65 @@ class WFCatalogCollector():
         now = datetime.datetime.now()
         start, end = self._getWindow()
 
-        # Loop over the window and collect files
-        pastFiles = []
-        for day in range(start, end):
-            pastFiles += self._collectFilesFromDate(now - datetime.timedelta(days=day))
+        # Collect the files of all days in the window
+        return self._collectFilesFromDates([now - datetime.timedelta(days=day) for day in range(start, end)])
 
-        return pastFiles
-
-    def _collectFilesFromDate(self, date):
+    def _collectFilesFromDates(self, dates):
         """
-        WFCatalogCollector._collectFilesFromDate
-        > collects the files for a given year and day
+        WFCatalogCollector._collectFilesFromDates
+        > collects the files for a list of days, in the order of the days
         """
 
-        # Get the year & day of year
-        jday = date.strftime("%j")
-        year = date.strftime("%Y")
+        # Group the days of year by year
+        years = {}
+        for date in dates:
+            years.setdefault(date.strftime("%Y"), set()).add(date.strftime("%j"))
 
-        # ODC directory structure makes it simple to loop over years and days
+        filesByDay = {}
 
+        # ODC directory structure makes it simple to loop over years and days
         if self.config['STRUCTURE'] == 'ODC':
-            directory = os.path.join(self.config['ARCHIVE_ROOT'], year, jday)
-            collectedFiles = [os.path.join(directory, f) for f in os.listdir(
-                directory) if os.path.isfile(os.path.join(directory, f))]
-
-        # SDS structure is slightly more complex, loop over all directories
-        # in a year and extract files ending with a given jday
+            for year, jdays in years.items():
+                for jday in jdays:
+                    directory = os.path.join(self.config['ARCHIVE_ROOT'], year, jday)
+                    filesByDay[(year, jday)] = [os.path.join(directory, f) for f in os.listdir(
+                        directory) if os.path.isfile(os.path.join(directory, f))]
+
+        # SDS structure is slightly more complex, scan all directories
+        # of a year once and group the files by the jday they end with
         elif self.config['STRUCTURE'] == 'SDS':
-            collectedFiles = []
-            directory = os.path.join(self.config['ARCHIVE_ROOT'], year)
-            for subdir, dirs, files in os.walk(directory):
-
-                for file in files:
-                    if file.endswith(jday) and os.path.isfile(os.path.join(subdir, file)):
-                        # if  os.path.basename(file).split('.')[5] == year :
-                        collectedFiles.append(os.path.join(subdir, file))
+            for year, jdays in years.items():
+                directory = os.path.join(self.config['ARCHIVE_ROOT'], year)
+                for file in self._scanFiles(directory):
+                    jday = file[-3:]
+                    if jday in jdays:
+                        filesByDay.setdefault((year, jday), []).append(file)
 
         else:
             raise Exception("WFCatalogCollector.getFilesFromDirectory: unknown directory structure.")
 
+        collectedFiles = []
+        for date in dates:
+            collectedFiles += filesByDay.pop((date.strftime("%Y"), date.strftime("%j")), [])
+
         return collectedFiles
 
+    def _scanFiles(self, directory):
+        """
+        WFCatalogCollector._scanFiles
+        > yields the paths of all files under a directory (recursively)
+        """
+
+        if not os.path.isdir(directory):
+            return
+
+        for entry in os.scandir(directory):
+            if entry.is_dir(follow_symlinks=False):
+                for file in self._scanFiles(entry.path):
+                    yield file
+            elif entry.is_file():
+                yield entry.path
+
     def _getFiles(self):
         """
         WFCatalogCollector._getFiles
@@ -339,15 +384,14 @@ class WFCatalogCollector():
 
         # Specific date as input (with optional range)
         elif self.args['date']:
-            self.files = []
             specific_date = datetime.datetime.strptime(self.args['date'], "%Y-%m-%d")
             n_days = int(self.args['range'])
             # Include a given range (default to 1)
-            for day in range(abs(n_days)):
-                if n_days > 0:
-                    self.files += self._collectFilesFromDate(specific_date + datetime.timedelta(days=day))
-                else:
-                    self.files += self._collectFilesFromDate(specific_date - datetime.timedelta(days=day))
+            if n_days > 0:
+                dates = [specific_date + datetime.timedelta(days=day) for day in range(n_days)]
+            else:
+                dates = [specific_date - datetime.timedelta(days=day) for day in range(abs(n_days))]
+            self.files = self._collectFilesFromDates(dates)
             self.log.info("Collected %d file(s) from date %s +%d days" %
                           (len(self.files), self.args['date'], n_days))
 
@@ -383,7 +427,7 @@ class WFCatalogCollector():
             return
 
         # Get the new files from the directory that are not in the database
-        new_files = [file for file in self.files if self._isNewDocument(file)]
+        new_files = self._getNewFiles(self.files)
         self.log.info("Discovered %d new file(s) for processing" %
                       (len(new_files)))
 
@@ -414,53 +458,47 @@ class WFCatalogCollector():
         """
         WFCatalogCollector._getChangedFiles
         > compares checksums in database against files in a directory
+        > with batched queries, hashing every file once
         """
 
-        changedFiles = []
+        changedFiles = set()
 
         if self.args['force']:
             self.log.info("Updating: forcing checksum change for database documents")
         else:
             self.log.info("Updating: start change detection through checksums of database documents")
 
-        # Go over all the files in the input
-        for file in self.files:
-
-            # Get the documents that depend on this file
-            # under document.files
-            for document in self.mongo.getDailyFilesById(file):
-
-                # The document update is forced
-                # We must update every document that depends on the file
-                if self.args['force']:
-                    self.log.info("Forcing update on %s" % document["fileId"])
-                    changedFiles.append(document["fileId"])
-                    continue
-
-                # Loop over all the used files
-                for used_files in document['files']:
-
-                    # If not forcing, just check the MD5 hash of the
-                    # actual passed file, and the MD5 hash in the database
-                    if used_files["name"] != os.path.basename(file):
-                        continue
-
-                    self.log.info("Comparing MD5checksums for %s" %
-                                  used_files['name'])
+        # Get the documents that depend on the input files
+        # under document.files, in batches
+        names = set(os.path.basename(file) for file in self.files)
+        documents = self.mongo.getDailyFilesByNames(self.files)
 
-                    fullPath = self._getFullPath(os.path.basename(file))
-                    MD5Hash = self._getMD5Hash(fullPath)
-
-                    # Compare the checksum
-                    if MD5Hash != used_files['chksm']:
-
-                        self.log.info(
-                            "Detected MD5checksum change for %s" % used_files['name'])
-                        self.log.info("Adding file %s for updating" %
-                                      document["fileId"])
-                        changedFiles.append(document["fileId"])
-
-        return list(set([self._getFullPath(filename) for filename in changedFiles]))
+        # The document update is forced
+        # We must update every document that depends on the files
+        if self.args['force']:
+            for document in documents:
+                self.log.info("Forcing update on %s" % document["fileId"])
+                changedFiles.add(document["fileId"])
+            return [self._getFullPath(filename) for filename in changedFiles]
+
+        # Hash every distinct input file used by the documents once
+        used = set(used_file['name'] for document in documents for used_file in document['files'])
+        hashes = {}
+        for name in names & used:
+            self.log.info("Comparing MD5checksums for %s" % name)
+            hashes[name] = self._getMD5Hash(self._getFullPath(name))
+
+        # Compare the checksums of the input files in every document
+        for document in documents:
+            for used_file in document['files']:
+                if used_file['name'] in hashes and hashes[used_file['name']] != used_file['chksm']:
+                    self.log.info(
+                        "Detected MD5checksum change for %s" % used_file['name'])
+                    self.log.info("Adding file %s for updating" %
+                                  document["fileId"])
+                    changedFiles.add(document["fileId"])
+
+        return [self._getFullPath(filename) for filename in changedFiles]
 
     def _getFullPath(self, file):
         """
@@ -471,6 +509,22 @@ class WFCatalogCollector():
 
         return self._getFileDirectory(self._getStatsObject(file))
 
+    def _getNewFiles(self, files):
+        """
+        WFCatalogCollector._getNewFiles
+        > returns the files without a daily stream in the database,
+        > checked with batched queries. If double is allowed
+        > this check is skipped.
+        """
+
+        if not self.config['MONGO']['ENABLED']:
+            return list(files)
+        elif self.config['MONGO']['ALLOW_DOUBLE']:
+            return list(files)
+        else:
+            existing = self.mongo.getExistingFileIds(files)
+            return [file for file in files if os.path.basename(file) not in existing]
+
     def _isNewDocument(self, file):
         """
         WFCatalogCollector._isNewDocument
@@ -486,43 +540,40 @@ class WFCatalogCollector():
         else:
             return self.mongo.getDocumentByFilename(file).count() == 0
 
-    def _callObsPyMetadata(self, files, start, end, granule):
+    def _getMetadataRunner(self):
         """
-        WFCatalogCollector._callObsPyMetadata
-        wrapper function to call obspy.signal.MSEEDMetdata
+        WFCatalogCollector._getMetadataRunner
+        > returns the metric computation runner of the calling thread
         """
 
-        # Throw an exception after the timeout (UNIX only)
-        signal.signal(signal.SIGALRM, self.handler)
-        signal.alarm(self.config['PROCESSING_TIMEOUT'])
-
-        try:
-            # Catch mSEED reading warnings
-            with warnings.catch_warnings(record=True) as w:
-                warnings.simplefilter('always')
-
-                # Skip continuous segments for hourly granules
-                if granule == 'daily':
-                    metadata = MSEEDMetadata(files, starttime=start, endtime=end, 
-                                             add_flags=self.args['flags'],
-                                             add_c_segments=self.args['csegs'])
-                elif granule == 'hourly':
-                    metadata = MSEEDMetadata(files, starttime=start, endtime=end,
-                                             add_flags=self.args['flags'],
-                                             add_c_segments=False)
+        runner = getattr(self._runners, 'runner', None)
+        if runner is None:
+            runner = wfmetrics.MetadataRunner(self.config['PROCESSING_TIMEOUT'],
+                                              self.config['TRACE_CACHE_SIZE'])
+            self._runners.runner = runner
 
-                metadata.meta.update({'warnings': len(w) > 0})
+        return runner
 
-        finally:
-            # Disable alarm
-            signal.alarm(0)
+    def _callObsPyMetadata(self, files, segments, neighbours=()):
+        """
+        WFCatalogCollector._callObsPyMetadata
+        wrapper function to call obspy.signal.MSEEDMetdata
+        > computes the daily and hourly granules from a single decoding
+        > of the files, only the records around the day are read from
+        > the neighbours. The computation is killed after the processing
+        > timeout and wfmetrics.MetadataTimeout is raised
+        """
 
-        return metadata.meta
+        return self._getMetadataRunner().run(wfmetrics.computeGranules, files,
+                                             segments['daily'], segments['hourly'],
+                                             self.args['flags'], self.args['csegs'],
+                                             neighbours)
 
     def collectMetadata(self, file):
         """
         WFCatalogCollector._collectMetadata
         > collects the metadata from the ObsPy mseedMetadata class
+        > returns False when the metadata could not be computed or stored
         """
         self.file_counter += 1
 
@@ -537,35 +588,34 @@ class WFCatalogCollector():
         except Exception as ex:
             self.log.error("Could not get neighbouring files")
             self.log.error(ex)
-            return
+            return False
 
-        # Get the daily granulated waveform metadata
+        # Get the daily and hourly granulated waveform metadata
         try:
-            granule = fas['segments']['daily']
-            daily_meta = self._callObsPyMetadata(fas['files'], granule['start'],
-                                                 granule['end'], 'daily')
-            daily_meta.update({'fileId': os.path.basename(file)})
+            granules = self._callObsPyMetadata(fas['files'], fas['segments'], fas['neighbours'])
+        except wfmetrics.MetadataTimeout as ex:
+            self.log.error("Metric calculation timed out for %s" %
+                           os.path.basename(file))
+            raise
         except Exception as ex:
             self.log.error("Could not get daily metadata for %s" %
                            os.path.basename(file))
             self.log.error(ex)
-            return
+            return False
+
+        daily_meta = granules['daily']
+        daily_meta.update({'fileId': os.path.basename(file)})
 
-        # Get the hourly granulated waveform metadata
-        hourly_meta_array = []
-        for granule in fas['segments']['hourly']:
-            try:
-                hourly_meta = self._callObsPyMetadata(fas['files'], granule['start'],
-                                                      granule['end'], 'hourly')
-                hourly_meta.update({'fileId': os.path.basename(file)})
-                hourly_meta_array.append(hourly_meta)
-            except Exception as ex:
-                if(str(ex) != "No data within the temporal constraints."):
-                    self.log.error("Could not get hourly metadata for %s" % os.path.basename(file))
-                    self.log.error(ex)
+        hourly_meta_array = granules['hourly']
+        for hourly_meta in hourly_meta_array:
+            hourly_meta.update({'fileId': os.path.basename(file)})
+
+        for error in granules['errors']:
+            self.log.error("Could not get hourly metadata for %s" % os.path.basename(file))
+            self.log.error(error)
 
         # Store the documents
-        self._storeOutput({
+        return self._storeOutput({
             'daily': daily_meta,
             'hourly': hourly_meta_array
         })
@@ -575,6 +625,7 @@ class WFCatalogCollector():
         WFCatalog._storeOutput
         > stores documents to MongoDB though 
         > the MongoDatabase() class
+        > returns False when a document could not be stored
         """
 
         # If a database is not connected throw to stdout
@@ -584,26 +635,18 @@ class WFCatalogCollector():
                 'hourly': documents['hourly']
             })
             self.log.info("Succesfully printed metrics to stdout")
-            return
+            return True
 
-        # When updating, make sure we remove the previous document
-        if self.args['update'] or self.args['delete']:
-            try:
-                for document in self.mongo.getDocumentByFilename(documents['daily']['fileId']):
-                    mongo_id = document['_id']
-                    self.mongo.removeDocumentsById(mongo_id)
-                    self.log.info("Succesfully removed document related to id %s." % mongo_id)
-            except Exception as ex:
-                self.log.error("Could not remove documents with id %s." % mongo_id)
-                self.log.exception(ex)
-                return
+        # When updating, replace the previous documents in place
+        if self.args['update']:
+            return self._replaceOutput(documents)
 
         # Final check and quit if the document with this fileId
         # is already in the database
         if not self._isNewDocument(documents['daily']['fileId']):
             self.log.error("Stop: document with this id is already in the database: %s" %
                            documents['daily']['fileId'])
-            return
+            return False
 
         # Store the daily output and get the parentID
         try:
@@ -613,30 +656,132 @@ class WFCatalogCollector():
         except Exception as ex:
             self.log.error("Could not store daily granule document to database")
             self.log.exception(ex)
-            return
+            return False
 
-        # Store the hourly output
+        stored = True
+
+        # Store the hourly output in bulk
+        if self.args['hourly']:
+            hourly_documents = []
+            for i, granule in enumerate(documents['hourly']):
+                try:
+                    hourly_documents.append(self._getDatabaseKeyMap(granule, id))
+                except Exception as ex:
+                    self.log.error("[%d/%d] Could not create hourly granule document" %
+                                   (i + 1, len(documents['hourly'])))
+                    self.log.exception(ex)
+                    stored = False
+
+            if not self._storeBulk(hourly_documents, 'hourly granule', self.mongo._storeGranules, 'hourly'):
+                stored = False
+
+        # Store continuous segments in bulk if the metadata is not continuous
+        if self.args['csegs'] and not qc_metadata_daily['cont']:
+            segment_documents = []
+            for segment in documents['daily']['c_segments']:
+                try:
+                    segment_documents.append(self._getDatabaseKeyMapContinuous(segment, id))
+                except Exception as ex:
+                    self.log.exception("Could not create continuous segment document")
+                    stored = False
+
+            if not self._storeBulk(segment_documents, 'continuous segment', self.mongo.storeContinuousSegments):
+                stored = False
+
+        return stored
+
+    def _replaceOutput(self, documents):
+        """
+        WFCatalog._replaceOutput
+        > replaces the daily granule of a file in place, under the
+        > same id, and swaps its hourly granules and continuous segments
+        > returns False when a document could not be replaced
+        """
+
+        fileId = documents['daily']['fileId']
+
+        try:
+            id = self.mongo.getStreamId(fileId)
+            qc_metadata_daily = self._getDatabaseKeyMap(documents['daily'], None)
+        except Exception as ex:
+            self.log.error("Could not create daily granule document")
+            self.log.exception(ex)
+            return False
+
+        complete = True
+
+        hourly_documents = []
         if self.args['hourly']:
             for i, granule in enumerate(documents['hourly']):
                 try:
-                    qc_metadata = self._getDatabaseKeyMap(granule, id)
-                    self.mongo._storeGranule(qc_metadata, 'hourly')
-                    self.log.info("[%d/%d] Succesfully stored hourly granule" %
-                                  (i + 1, len(documents['hourly'])))
+                    hourly_documents.append(self._getDatabaseKeyMap(granule, id))
                 except Exception as ex:
-                    self.log.error("Could not store hourly granule document to database")
+                    self.log.error("[%d/%d] Could not create hourly granule document" %
+                                   (i + 1, len(documents['hourly'])))
                     self.log.exception(ex)
+                    complete = False
 
-        # Store continuous segments if the metadata is not continuous
+        segment_documents = []
         if self.args['csegs'] and not qc_metadata_daily['cont']:
             for segment in documents['daily']['c_segments']:
                 try:
-                    qc_metadata = self._getDatabaseKeyMapContinuous(segment, id)
-                    self.mongo.storeContinuousSegment(qc_metadata)
+                    segment_documents.append(self._getDatabaseKeyMapContinuous(segment, id))
                 except Exception as ex:
-                    self.log.exception("Could not store continuous segment to database")
-            self.log.info("Succesfully stored %d continuous segment(s) to database" % 
-                          len(documents['daily']['c_segments']))
+                    self.log.exception("Could not create continuous segment document")
+                    complete = False
+
+        try:
+            self.mongo.replaceStream(id, qc_metadata_daily, hourly_documents, segment_documents)
+        except Exception as ex:
+            self.log.error("Could not replace documents of %s" % fileId)
+            self.log.exception(ex)
+            return False
+
+        self.log.info("Succesfully replaced daily granule %s with %d hourly granule(s) and %d continuous segment(s)" %
+                      (id, len(hourly_documents), len(segment_documents)))
+
+        return complete
+
+    def removeDocuments(self, files):
+        """
+        WFCatalogCollector.removeDocuments
+        > removes the daily and hourly streams and continuous segments
+        > of the files in bulk, without computing any metrics
+        """
+
+        ids = self.mongo.getDocumentIdsByFilenames(files)
+        removed = self.mongo.removeDocumentsByIds(ids)
+
+        self.log.info("Succesfully removed %d daily stream(s) and related documents of %d file(s)" %
+                      (removed, len(files)))
+
+        return removed
+
+    def _storeBulk(self, documents, name, store, *args):
+        """
+        WFCatalogCollector._storeBulk
+        > stores a list of documents with a single bulk insert
+        > and logs the documents that could not be stored
+        > returns False when a document could not be stored
+        """
+
+        if not documents:
+            return True
+
+        try:
+            ids, errors = store(documents, *args)
+        except Exception as ex:
+            self.log.error("Could not store %d %s document(s) to database" % (len(documents), name))
+            self.log.exception(ex)
+            return False
+
+        for index in sorted(errors):
+            self.log.error("[%d/%d] Could not store %s document to database: %s" %
+                           (index + 1, len(documents), name, errors[index]))
+
+        self.log.info("Succesfully stored %d/%d %s(s) to database" % (len(ids), len(documents), name))
+
+        return not errors
 
     def _getDatabaseKeyMapContinuous(self, trace, id):
         """
@@ -887,21 +1032,14 @@ class WFCatalogCollector():
         WFCatalogCollector._getMD5Hash
         > Method to generate md5 hashes used 
         > for the checksum field
+        > (memoised with the SHA256 used by iRODS, see wfchecksum)
         """
         try:
-            BLOCKSIZE = 65536
-            hasher = hashlib.md5()
-            with open(f, 'rb') as afile:
-                buf = afile.read(BLOCKSIZE)
-                while len(buf) > 0:
-                    hasher.update(buf)
-                    buf = afile.read(BLOCKSIZE)
+            return checksums.md5(f)
         except Exception as ex:
             self.log.error(ex)
             return None
 
-        return hasher.hexdigest()
-
     def _getStatsObject(self, file):
         """
         WFCatalogCollector._getStatsObject
@@ -1069,4 +1207,6 @@ class WFCatalogCollector():
                                                             os.path.basename(file),
                                                             [os.path.basename(f) for f in day_files]))
 
-        return {'files': day_files, 'segments': self._getFileSegments(file)}
+        return {'files': day_files,
+                'neighbours': [f for f in day_files if f != file],
+                'segments': self._getFileSegments(file)}
@@ -0,0 +1,169 @@
+#! /usr/bin/env python
+"""
+#
+#
+#
+
+"""
+
+import os
+import sqlite3
+import datetime
+
+# number of values per SQL IN clause
+BATCH_SIZE = 500
+
+# number of processed files buffered before writing them to the index
+FLUSH_SIZE = 500
+
+
+class FileIndex():
+    """Persistent on-disk index of the archive files processed by previous runs.
+
+    Each processed file is stored with its size, modification time and inode
+    at the time it was processed. A file is new or changed when it's not in
+    the index or when any of these differ from the file on disk.
+
+    Attributes
+    ----------
+    path : `str`
+        Path of the SQLite database file.
+    log : `logging.Logger`
+        The WFCatalog Logger object.
+    """
+
+    def __init__(self, path, log):
+
+        self.path = path
+        self.log = log
+        self.conn = None
+        self.pending = []
+
+    def _connect(self):
+        """Opens the database, creating the table if needed."""
+
+        if self.conn:
+            return
+
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS files ("
+                          "path TEXT PRIMARY KEY, "
+                          "size INTEGER, "
+                          "mtime_ns INTEGER, "
+                          "inode INTEGER, "
+                          "processed_at TEXT)")
+        self.conn.commit()
+
+    def _stat(self, file):
+        """Returns the (size, mtime_ns, inode) identity of a file, or None if
+        it does not exist."""
+
+        try:
+            stat = os.stat(file)
+        except OSError:
+            return None
+
+        return (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+    def getChangedFiles(self, files):
+        """Returns the files that are new or changed since they were processed.
+
+        Parameters
+        ----------
+        files : `list`
+            Full paths of the files.
+
+        Returns
+        -------
+        `list`
+            The new or changed files, in the given order.
+        """
+
+        self._connect()
+
+        files = list(files)
+        indexed = {}
+        for i in range(0, len(files), BATCH_SIZE):
+            batch = files[i:i + BATCH_SIZE]
+            query = "SELECT path, size, mtime_ns, inode FROM files WHERE path IN (%s)" % ",".join("?" * len(batch))
+            for path, size, mtime_ns, inode in self.conn.execute(query, batch):
+                indexed[path] = (size, mtime_ns, inode)
+
+        return [file for file in files if indexed.get(file) != self._stat(file)]
+
+    def markProcessed(self, file):
+        """Records the current state of a file as processed. Records are
+        buffered and written every FLUSH_SIZE files, see `flush`.
+
+        Parameters
+        ----------
+        file : `str`
+            Full file path.
+        """
+
+        identity = self._stat(file)
+        if identity is None:
+            return
+
+        self.pending.append((file,) + identity + (datetime.datetime.now().isoformat(),))
+        if len(self.pending) >= FLUSH_SIZE:
+            self.flush()
+
+    def flush(self):
+        """Writes the buffered processed files to the index."""
+
+        if not self.pending:
+            return
+
+        self._connect()
+        self.conn.executemany("INSERT OR REPLACE INTO files (path, size, mtime_ns, inode, processed_at) "
+                              "VALUES (?, ?, ?, ?, ?)", self.pending)
+        self.conn.commit()
+        self.pending = []
+
+    def forget(self, files):
+        """Removes files from the index, so they are processed again.
+
+        Parameters
+        ----------
+        files : `list`
+            Full file paths.
+        """
+
+        self._connect()
+        self.flush()
+
+        files = list(files)
+        for i in range(0, len(files), BATCH_SIZE):
+            batch = files[i:i + BATCH_SIZE]
+            self.conn.execute("DELETE FROM files WHERE path IN (%s)" % ",".join("?" * len(batch)), batch)
+        self.conn.commit()
+
+    def rebuild(self, files):
+        """Replaces the content of the index by the given files, in their
+        current state.
+
+        Parameters
+        ----------
+        files : `list`
+            Full paths of the files already processed.
+        """
+
+        self._connect()
+        self.pending = []
+        self.conn.execute("DELETE FROM files")
+        self.conn.commit()
+
+        for file in files:
+            self.markProcessed(file)
+        self.flush()
+
+        self.log.info("File index %s rebuilt with %d file(s)" % (self.path, len(files)))
+
+    def close(self):
+        """Writes the buffered files and closes the index."""
+
+        self.flush()
+        if self.conn:
+            self.conn.close()
+            self.conn = None
@@ -0,0 +1,825 @@
+"""
+WFCatalog metric computation
+
+Runs the ObsPy MSEEDMetadata computations of the collector in a
+dedicated child process, so that a computation stuck on a corrupt
+mSEED file can be killed after PROCESSING_TIMEOUT seconds. This works
+in any thread or (non daemonic) worker process, unlike SIGALRM.
+
+All granules of a file (daily and hourly) are computed in one call
+from the same decoded data, see computeGranules.
+
+The child process keeps the decoded files in a bounded LRU cache
+(TRACE_CACHE_SIZE files), so the neighbouring day files of consecutive
+days of a stream are read and decoded only once. Neighbouring files
+that are not cached are read partially: only the records overlapping
+the metric window are loaded.
+
+The miniSEED header flags of all granules are computed from a single
+scan of the record headers of each file, see readFlagRecords. The
+record headers are cached alongside the decoded files, and only the
+boundary records of uncached neighbouring files are scanned.
+
+  > runner = MetadataRunner(120, 4)
+  > granules = runner.run(computeGranules, files, daily, hourly, False, True)
+
+"""
+
+import io
+import os
+import uuid
+import ctypes
+import warnings
+import threading
+import collections
+import multiprocessing
+from operator import attrgetter
+
+import numpy as np
+
+# ObsPy mSEED-QC is required
+try:
+    from obspy import read, Stream, UTCDateTime
+    from obspy.io.mseed.util import get_record_information
+    from obspy.io.mseed.headers import clibmseed, MSRecord, HPTMODULUS, MS_NOERROR
+    from obspy.signal.quality_control import MSEEDMetadata, _PRODUCER
+except ImportError as ex:
+    raise ImportError('Failure to load MSEEDMetadata; ObsPy mSEED-QC is required.')
+
+
+class MetadataTimeout(Exception):
+    """Raised when a metric computation exceeds the processing timeout."""
+    pass
+
+
+class TraceCache():
+    """Bounded LRU cache of decoded mSEED files and of their record
+    headers (see readFlagRecords).
+
+    Entries are keyed on the file path and validated against the file
+    modification time and size, so a changed file is decoded again.
+    """
+
+    def __init__(self, maxsize=4):
+
+        self.maxsize = maxsize
+        self.streams = collections.OrderedDict()
+        self.records = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def _lookup(self, entries, file, identity):
+        """
+        TraceCache._lookup
+        > returns the cached value of a file in entries or None
+        """
+
+        with self.lock:
+            if file in entries and entries[file][0] == identity:
+                entries.move_to_end(file)
+                return entries[file][1]
+
+        return None
+
+    def _store(self, entries, file, identity, value):
+        """
+        TraceCache._store
+        > caches the value of a file in entries, evicting the least
+        > recently used files
+        """
+
+        with self.lock:
+            entries[file] = (identity, value)
+            entries.move_to_end(file)
+            while len(entries) > self.maxsize:
+                entries.popitem(last=False)
+
+    def get(self, file):
+        """
+        TraceCache.get
+        > returns the decoded stream of a file, reading it on a cache miss
+        """
+
+        stat = os.stat(file)
+        identity = (stat.st_mtime, stat.st_size)
+
+        stream = self._lookup(self.streams, file, identity)
+        if stream is None:
+            stream = read(file, format="mseed")
+            self._store(self.streams, file, identity, stream)
+
+        return stream
+
+    def getBoundary(self, file, start, end):
+        """
+        TraceCache.getBoundary
+        > returns the cached stream of a neighbouring file if present,
+        > otherwise only the records overlapping [start, end] (not cached)
+        """
+
+        stat = os.stat(file)
+        identity = (stat.st_mtime, stat.st_size)
+
+        stream = self._lookup(self.streams, file, identity)
+        if stream is None:
+            stream = readBoundary(file, start, end)
+
+        return stream
+
+    def getFlagRecords(self, file, start=None, end=None):
+        """
+        TraceCache.getFlagRecords
+        > returns the record headers of a file, scanning it on a cache
+        > miss. With a window [start, end] (neighbouring files) only the
+        > records overlapping it are scanned when the file is not cached,
+        > and are not cached
+        """
+
+        stat = os.stat(file)
+        identity = (stat.st_mtime, stat.st_size)
+
+        records = self._lookup(self.records, file, identity)
+        if records is not None:
+            return records
+
+        if start is not None and end is not None:
+            return readFlagRecords(file, start, end)
+
+        records = readFlagRecords(file)
+        self._store(self.records, file, identity, records)
+
+        return records
+
+    def clear(self):
+        """
+        TraceCache.clear
+        > drops all cached streams and record headers
+        """
+
+        with self.lock:
+            self.streams.clear()
+            self.records.clear()
+
+
+# Cache of the process computing the metrics
+traceCache = TraceCache()
+
+
+def readBoundaryRecords(file, start, end):
+    """
+    wfmetrics.readBoundaryRecords
+    > returns the raw records of a time ordered mSEED file that overlap
+    > the window [start, end]. Record headers are scanned from the
+    > file edge facing the window, backwards for the previous day file
+    > and forwards for the next day file, until the window is left.
+    > Returns None for files with variable record lengths, which must
+    > be read entirely.
+    """
+
+    start = UTCDateTime(start)
+    end = UTCDateTime(end)
+
+    with open(file, 'rb') as fh:
+
+        first = get_record_information(fh)
+        reclen = first['record_length']
+        nrec, excess = divmod(first['filesize'], reclen)
+
+        if excess != 0:
+            return None
+
+        backwards = first['starttime'] < start
+        if backwards:
+            indices = range(nrec - 1, -1, -1)
+        else:
+            indices = range(nrec)
+
+        selected = []
+        for i in indices:
+
+            fh.seek(0)
+            info = get_record_information(fh, i * reclen)
+            if info['record_length'] != reclen:
+                return None
+
+            delta = 1.0 / info['samp_rate'] if info['samp_rate'] else 0
+
+            # Record ends before the window
+            if info['endtime'] + delta <= start:
+                if backwards:
+                    break
+                continue
+
+            # Record starts after the window
+            if info['starttime'] > end:
+                if not backwards:
+                    break
+                continue
+
+            selected.append(i)
+
+        buf = io.BytesIO()
+        for i in sorted(selected):
+            fh.seek(i * reclen)
+            buf.write(fh.read(reclen))
+
+    return buf.getvalue()
+
+
+def readBoundary(file, start, end):
+    """
+    wfmetrics.readBoundary
+    > reads the records of a time ordered mSEED file that overlap
+    > the window [start, end], see readBoundaryRecords
+    """
+
+    data = readBoundaryRecords(file, start, end)
+
+    if data is None:
+        return read(file, format="mseed")
+
+    if not data:
+        return Stream()
+
+    return read(io.BytesIO(data), format="mseed")
+
+
+def loadStreams(files, cache, start=None, end=None, neighbours=()):
+    """
+    wfmetrics.loadStreams
+    > returns {file: stream} of decoded files from the cache, only the
+    > records around the window [start, end] are needed of the neighbours
+    """
+
+    streams = {}
+    for file in files:
+        if file in neighbours and start is not None and end is not None:
+            streams[file] = cache.getBoundary(file, start, end)
+        else:
+            streams[file] = cache.get(file)
+
+    return streams
+
+
+# miniSEED header flag names, by bit
+DATA_QUALITY_FLAGS = ["amplifier_saturation", "digitizer_clipping", "spikes", "glitches",
+                      "missing_padded_data", "telemetry_sync_error", "digital_filter_charging",
+                      "suspect_time_tag"]
+ACTIVITY_FLAGS = ["calibration_signal", "time_correction_applied", "event_begin", "event_end",
+                  "positive_leap", "negative_leap", "event_in_progress"]
+IO_AND_CLOCK_FLAGS = ["station_volume", "long_record_read", "short_record_read",
+                      "start_time_series", "end_time_series", "clock_locked"]
+
+
+def readFlagRecords(file, start=None, end=None):
+    """
+    wfmetrics.readFlagRecords
+    > scans the record headers of a mSEED file once, like
+    > obspy.io.mseed.util.get_flags, and returns the list of records
+    > {'start', 'end', 'delta', 'tq', 'tc', 'io', 'dq', 'ac'} (times in
+    > seconds), from which the flags of any window are computed by getFlags
+    > with a window [start, end] only the records overlapping it are
+    > scanned, see readBoundaryRecords
+    """
+
+    data = None
+    if start is not None and end is not None:
+        data = readBoundaryRecords(file, start, end)
+
+    if data is None:
+        bfr = np.fromfile(file, dtype=np.int8)
+    else:
+        bfr = np.frombuffer(bytearray(data), dtype=np.int8)
+
+    records = []
+    offset = 0
+
+    msr = clibmseed.msr_init(ctypes.POINTER(MSRecord)())
+    try:
+        while True:
+            record = bfr[offset: offset + 8192]
+            if len(record) < 48:
+                break
+            if clibmseed.msr_parse(record, len(record), ctypes.pointer(msr), -1, 0, 0) != MS_NOERROR:
+                break
+            offset += msr.contents.reclen
+
+            delta = 1 / msr.contents.samprate
+            records.append({
+                'start': clibmseed.msr_starttime(msr) / HPTMODULUS,
+                'end': clibmseed.msr_endtime(msr) / HPTMODULUS + delta,
+                'delta': delta,
+                'tq': msr.contents.Blkt1001.contents.timing_qual if msr.contents.Blkt1001 else None,
+                'tc': msr.contents.fsdh.contents.time_correct,
+                'io': msr.contents.fsdh.contents.io_flags,
+                'dq': msr.contents.fsdh.contents.dq_flags,
+                'ac': msr.contents.fsdh.contents.act_flags
+            })
+    finally:
+        clibmseed.msr_free(ctypes.pointer(msr))
+
+    return records
+
+
+def getFlags(fileRecords, starttime, endtime):
+    """
+    wfmetrics.getFlags
+    > same as obspy.io.mseed.util.get_flags for the window [starttime,
+    > endtime), taking the records of readFlagRecords (a list per file)
+    > instead of reading the files
+    """
+
+    starttime = float(starttime)
+    endtime = float(endtime)
+
+    # Clip the records to the window
+    records = []
+    for fileRecord in fileRecords:
+        for record in fileRecord:
+            if record['end'] <= starttime or record['start'] >= endtime:
+                continue
+            record = dict(record)
+            record['start'] = max(record['start'], starttime)
+            record['end'] = min(record['end'], endtime)
+            records.append(record)
+
+    records.reverse()
+    records.sort(key=lambda x: x["end"], reverse=True)
+
+    names = {'dq': DATA_QUALITY_FLAGS, 'ac': ACTIVITY_FLAGS, 'io': IO_AND_CLOCK_FLAGS}
+    counts = dict((key, collections.OrderedDict((name, 0) for name in names[key])) for key in names)
+    seconds = dict((key, collections.OrderedDict((name, 0) for name in names[key])) for key in names)
+
+    coverage = None
+    used_record_count = 0
+    timing_correction = 0.0
+    timing_correction_count = 0
+    tq = []
+
+    for record in records:
+
+        for key in names:
+            for bit, name in enumerate(names[key]):
+                if record[key] & (1 << bit):
+                    counts[key][name] += 1
+
+        # Records sorted by end time backwards, cut overlaps
+        if coverage is None:
+            coverage = [record["start"], record["end"]]
+        else:
+            tolerated_end = coverage[0] - 0.5 * record['delta']
+            if record["start"] >= coverage[0]:
+                continue
+            if record["end"] > coverage[0] or record["end"] > tolerated_end:
+                record["end"] = coverage[0]
+            if record["start"] < coverage[0]:
+                coverage[0] = record["start"]
+
+        record_length_seconds = record["end"] - record["start"]
+        if record_length_seconds <= 0.0:
+            continue
+
+        used_record_count += 1
+
+        for key in names:
+            for bit, name in enumerate(names[key]):
+                if record[key] & (1 << bit):
+                    seconds[key][name] += record_length_seconds
+
+        if record["tq"] is not None:
+            tq.append(float(record["tq"]))
+
+        if record["tc"] != 0:
+            timing_correction += record_length_seconds
+            timing_correction_count += 1
+
+    total_time_seconds = endtime - starttime
+    if total_time_seconds:
+        for key in names:
+            for name in names[key]:
+                seconds[key][name] /= total_time_seconds * 1e-2
+        timing_correction /= total_time_seconds * 1e-2
+
+    if tq and len(tq) == used_record_count:
+        tq = np.array(tq, dtype=np.float64)
+        tq = {
+            "all_values": tq,
+            "min": tq.min(),
+            "max": tq.max(),
+            "mean": tq.mean(),
+            "median": np.median(tq),
+            "lower_quartile": np.percentile(tq, 25),
+            "upper_quartile": np.percentile(tq, 75)
+        }
+    else:
+        tq = {}
+
+    return {
+        'timing_correction': timing_correction,
+        'timing_correction_count': timing_correction_count,
+        'io_and_clock_flags_percentages': seconds['io'],
+        'io_and_clock_flags_counts': counts['io'],
+        'data_quality_flags_percentages': seconds['dq'],
+        'data_quality_flags_counts': counts['dq'],
+        'activity_flags_percentages': seconds['ac'],
+        'activity_flags_counts': counts['ac'],
+        'timing_quality': tq,
+        'record_count': len(records),
+        'number_of_records_used': used_record_count
+    }
+
+
+class CachedMSEEDMetadata(MSEEDMetadata):
+    """MSEEDMetadata taking already decoded traces instead of reading the
+    files.
+
+    Mirrors MSEEDMetadata.__init__ (ObsPy >= 1.0) with the reads replaced
+    by slices of the given streams (see loadStreams), so several windows
+    can be computed from a single decoding. The slices share the sample
+    arrays with the streams, which must not be modified. MiniSEED header
+    flags are computed from the records of readFlagRecords (flagRecords,
+    {file: records}) instead of scanning the files again.
+    """
+
+    def __init__(self, files, streams, starttime=None, endtime=None,
+                 add_c_segments=True, add_flags=False, flagRecords=None):
+
+        self.streams = streams
+        self.flagRecords = flagRecords
+        self.data = Stream()
+        self.all_files = files
+        self.files = []
+
+        if starttime is not None:
+            starttime = UTCDateTime(starttime)
+        if endtime is not None:
+            endtime = UTCDateTime(endtime)
+
+        self.window_start = starttime
+        self.window_end = endtime
+
+        # Exclude the sample at T1, like MSEEDMetadata
+        if endtime is not None:
+            endtime_left = endtime - 1e-6
+        else:
+            endtime_left = None
+
+        for file in files:
+            st = self.streams[file].slice(starttime, endtime_left,
+                                          nearest_sample=False)
+
+            if not st:
+                continue
+
+            self.files.append(file)
+            self.data.extend([tr for tr in st if tr.stats.npts != 0])
+
+        if not self.data:
+            raise ValueError("No data within the temporal constraints.")
+
+        ids = [tr.id + "." + str(tr.stats.mseed.dataquality) for tr in
+               self.data]
+        if len(set(ids)) != 1:
+            raise ValueError("All traces must have the same SEED id and "
+                             "quality.")
+
+        final_trace = max(self.data, key=attrgetter('stats.endtime')).stats
+        self.endtime = endtime or final_trace.endtime + final_trace.delta
+
+        self.data.sort()
+
+        self.starttime = starttime or self.data[0].stats.starttime
+        self.total_time = self.endtime - self.starttime
+
+        self.meta = {
+            "wfmetadata_id": "smi:local/qc/" + str(uuid.uuid4()),
+            "producer": _PRODUCER,
+            "waveform_type": "seismic",
+            "waveform_format": "miniSEED",
+            "version": "1.0.0"
+        }
+
+        self._get_gaps_and_overlaps()
+
+        self._extract_mseed_stream_metadata()
+        self._compute_sample_metrics()
+
+        if add_flags:
+            self._extract_mseed_flags()
+
+        if add_c_segments:
+            self._compute_continuous_seg_sample_metrics()
+
+    def _extract_mseed_flags(self):
+        """
+        CachedMSEEDMetadata._extract_mseed_flags
+        > same as MSEEDMetadata._extract_mseed_flags, taking the
+        > records from flagRecords instead of the files
+        """
+
+        flags = getFlags([self.flagRecords[file] for file in self.files],
+                         self.starttime, self.endtime)
+
+        tq = flags["timing_quality"]
+
+        meta = self.meta
+        meta['num_records'] = flags['record_count']
+
+        # Set MiniSEED header counts
+        meta['miniseed_header_counts'] = {
+            'timing_correction': flags['timing_correction_count'],
+            'activity_flags': flags['activity_flags_counts'],
+            'io_and_clock_flags': flags['io_and_clock_flags_counts'],
+            'data_quality_flags': flags['data_quality_flags_counts']
+        }
+
+        # Set MiniSEED header percentages, timing quality statistics
+        # only when every record has a timing quality
+        meta['miniseed_header_percentages'] = {
+            'timing_correction': flags['timing_correction'],
+            'timing_quality_mean': tq.get("mean"),
+            'timing_quality_min': tq.get("min"),
+            'timing_quality_max': tq.get("max"),
+            'timing_quality_median': tq.get("median"),
+            'timing_quality_lower_quartile': tq.get("lower_quartile"),
+            'timing_quality_upper_quartile': tq.get("upper_quartile"),
+            'activity_flags': flags['activity_flags_percentages'],
+            'data_quality_flags': flags['data_quality_flags_percentages'],
+            'io_and_clock_flags': flags['io_and_clock_flags_percentages']
+        }
+
+    def _get_gaps_and_overlaps(self):
+        """
+        CachedMSEEDMetadata._get_gaps_and_overlaps
+        > same as MSEEDMetadata._get_gaps_and_overlaps, taking the
+        > trace headers from the streams instead of the files
+        """
+
+        self.all_data = Stream()
+        for file in self.all_files:
+            self.all_data.extend(self.streams[file].traces)
+        self.all_data.sort()
+
+        body_gap = []
+        body_overlap = []
+
+        coverage = None
+        for trace in self.all_data:
+
+            trace_end = trace.stats.endtime + trace.stats.delta
+            trace_start = trace.stats.starttime
+
+            if self.window_start is not None:
+                if trace_end <= self.window_start:
+                    continue
+                cut_trace_start = max(trace_start, self.window_start)
+            else:
+                cut_trace_start = trace_start
+
+            if self.window_end is not None:
+                if trace_start > self.window_end:
+                    continue
+                cut_trace_end = min(trace_end, self.window_end)
+            else:
+                cut_trace_end = trace_end
+
+            # Time tolerance of 0.5 * delta
+            time_tolerance_max = trace_end + 0.5 * trace.stats.delta
+            time_tolerance_min = trace_end - 0.5 * trace.stats.delta
+
+            if coverage is None:
+                coverage = {
+                    'start': trace_start,
+                    'end': trace_end,
+                    'end_min': time_tolerance_min,
+                    'end_max': time_tolerance_max
+                }
+                continue
+
+            if trace_start > coverage['end_max']:
+                body_gap.append(cut_trace_start - coverage['end'])
+
+            if trace_start <= coverage['end_min']:
+                min_end = min(cut_trace_end, coverage['end'])
+                body_overlap.append(min_end - cut_trace_start)
+
+            if trace_end > coverage['end']:
+                coverage['end'] = trace_end
+                coverage['end_min'] = time_tolerance_min
+                coverage['end_max'] = time_tolerance_max
+
+        # Start and end gaps caused by the window
+        self.meta['start_gap'] = None
+        self.meta['end_gap'] = None
+        if self.window_start is not None:
+            if coverage['start'] > self.window_start:
+                self.meta['start_gap'] = coverage['start'] - self.window_start
+                body_gap.append(self.meta['start_gap'])
+        if self.window_end is not None:
+            if coverage['end'] < self.window_end:
+                self.meta['end_gap'] = self.window_end - coverage['end']
+                body_gap.append(self.meta['end_gap'])
+
+        self.meta['num_gaps'] = len(body_gap)
+        self.meta['sum_gaps'] = sum(body_gap)
+        self.meta['max_gap'] = max(body_gap) if body_gap else None
+
+        self.meta['num_overlaps'] = len(body_overlap)
+        self.meta['sum_overlaps'] = sum(body_overlap)
+        self.meta['max_overlap'] = max(body_overlap) if body_overlap else None
+
+
+def _computeWindow(files, streams, start, end, flags, csegs, flagRecords=None):
+    """
+    wfmetrics._computeWindow
+    > computes the metadata dictionary of the streams for [start, end)
+    """
+
+    # Catch mSEED reading warnings
+    with warnings.catch_warnings(record=True) as w:
+        warnings.simplefilter('always')
+
+        metadata = CachedMSEEDMetadata(files, streams,
+                                       starttime=start, endtime=end,
+                                       add_flags=flags,
+                                       add_c_segments=csegs,
+                                       flagRecords=flagRecords)
+
+        metadata.meta.update({'warnings': len(w) > 0})
+
+    return metadata.meta
+
+
+def computeGranules(files, daily, hourly, flags, csegs, neighbours=()):
+    """
+    wfmetrics.computeGranules
+    > computes the daily and all hourly granules of a file from a single
+    > decoding of the files. daily is a {'start', 'end'} window and hourly
+    > a list of them (continuous segments are only computed for daily)
+    > returns {'daily': meta, 'hourly': [meta, ...], 'errors': [str, ...]}
+    > hourly windows without data are skipped, other hourly failures
+    > are reported in errors
+    """
+
+    streams = loadStreams(files, traceCache, daily['start'], daily['end'], neighbours)
+
+    # Record headers are scanned once for the flags of all granules,
+    # only the records around the window are needed of the neighbours
+    flagRecords = None
+    if flags:
+        flagRecords = {}
+        for file in files:
+            if file in neighbours:
+                flagRecords[file] = traceCache.getFlagRecords(file, daily['start'], daily['end'])
+            else:
+                flagRecords[file] = traceCache.getFlagRecords(file)
+
+    granules = {
+        'daily': _computeWindow(files, streams, daily['start'], daily['end'], flags, csegs, flagRecords),
+        'hourly': [],
+        'errors': []
+    }
+
+    for window in hourly:
+        try:
+            granules['hourly'].append(_computeWindow(files, streams, window['start'],
+                                                     window['end'], flags, False, flagRecords))
+        except Exception as ex:
+            if str(ex) != "No data within the temporal constraints.":
+                granules['errors'].append("%s - %s: %s" % (window['start'], window['end'], ex))
+
+    return granules
+
+
+def _serve(conn, cacheSize):
+    """
+    wfmetrics._serve
+    > main loop of the child process, runs the received calls
+    > and sends back (True, result) or (False, exception)
+    """
+
+    traceCache.maxsize = cacheSize
+
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            return
+
+        if task is None:
+            return
+
+        func, args = task
+        try:
+            conn.send((True, func(*args)))
+        except Exception as ex:
+            try:
+                conn.send((False, ex))
+            except Exception:
+                # The exception itself could not be pickled
+                conn.send((False, Exception(str(ex))))
+
+
+class MetadataRunner():
+    """Runs metric computations in a child process that is killed and
+    restarted when a computation exceeds the timeout.
+
+    The child process is kept alive between calls. A runner must only be
+    used by one thread at a time, see `WFCatalogCollector._getMetadataRunner`.
+    Inside daemonic processes, which cannot have children, the computation
+    runs in a daemon thread that is abandoned on timeout.
+    """
+
+    def __init__(self, timeout, cacheSize=4):
+
+        self.timeout = timeout
+        self.cacheSize = cacheSize
+        self.process = None
+        self.conn = None
+
+    def _start(self):
+        """
+        MetadataRunner._start
+        > starts the child process and the pipe to it
+        """
+
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_serve, args=(child_conn, self.cacheSize))
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+
+    def stop(self):
+        """
+        MetadataRunner.stop
+        > kills the child process
+        """
+
+        if self.process is None:
+            return
+
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process.join()
+        self.conn.close()
+
+        self.process = None
+        self.conn = None
+
+    def run(self, func, *args):
+        """
+        MetadataRunner.run
+        > returns func(*args) computed in the child process, raises
+        > MetadataTimeout if it does not return within the timeout
+        """
+
+        if multiprocessing.current_process().daemon:
+            traceCache.maxsize = self.cacheSize
+            return self._runInThread(func, args)
+
+        if self.process is None or not self.process.is_alive():
+            self._start()
+
+        self.conn.send((func, args))
+
+        # Kill the child on timeout, a new one is started on the next call
+        if not self.conn.poll(self.timeout):
+            self.stop()
+            raise MetadataTimeout("Metric calculation has timed out")
+
+        try:
+            success, result = self.conn.recv()
+        except EOFError:
+            self.stop()
+            raise Exception("Metric calculation process exited unexpectedly")
+
+        if not success:
+            raise result
+
+        return result
+
+    def _runInThread(self, func, args):
+        """
+        MetadataRunner._runInThread
+        > fallback of run for daemonic processes
+        """
+
+        output = {}
+
+        def target():
+            try:
+                output['result'] = func(*args)
+            except Exception as ex:
+                output['error'] = ex
+
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+        thread.join(self.timeout)
+
+        if thread.is_alive():
+            raise MetadataTimeout("Metric calculation has timed out")
+
+        if 'error' in output:
+            raise output['error']
+
+        return output['result']
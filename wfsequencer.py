@@ -9,6 +9,24 @@ import os
 import sys
 import json
 import collections
+from concurrent.futures import ThreadPoolExecutor
+
+from wfmetrics import MetadataTimeout
+
+# metadata attribute set on the data objects that are replicated
+REPLICA_AVU = 'EUDAT/REPLICA'
+
+# metadata attribute set by each rule on the data object, a rule is
+# skipped when the object already has it
+RULE_AVUS = {
+    'PID': 'PID',
+    'REPLICA': REPLICA_AVU,
+    'REGISTER': 'EUDAT/ROR'
+}
+
+# returned by a rule whose work is deferred, the outcome is recorded once
+# the work is done, see sequencer.doSequence
+DEFERRED = 'deferred'
 
 
 class sequencer(object):
@@ -41,6 +59,9 @@ class sequencer(object):
         - ``start_time``: Date of record (`datetime`).
         - ``datastations``: The catalog of station coordinates
                             given by `dublinCore.getDataStations` (`dict`).
+    summary : `collections.Counter`
+        Outcome counts of the rules applied so far, keyed by
+        '<step> <outcome>', plus the number of sequences run.
     """
 
     def __init__(self, config, log, irods, mongo, WFcollector, dublinCore):
@@ -58,17 +79,48 @@ class sequencer(object):
         self.mongo = mongo
         self.WFcollector = WFcollector
         self.dublinCore = dublinCore
+        self.summary = collections.Counter()
+
+        # (object path, file) waiting for a batched PID, see PidRule
+        self.pidQueue = []
+        self.pidCollection = None
+
+        # PIDs are batched unless a later step needs the PID of the object
+        self.pidBatch = 'PID_BATCH' in self.ruleMap['RULE_PATHS'] and config['IRODS']['PID_BATCH_SIZE'] > 1
+        sequence = self.ruleMap['SEQUENCE']
+        if self.pidBatch and 'PID' in sequence and set(sequence[sequence.index('PID'):]) & set(['REPLICA', 'REGISTER']):
+            self.log.warning("PID_BATCH ignored: REPLICA and REGISTER need the PID of the object")
+            self.pidBatch = False
+
+        # files whose sequence and deferred work are done, the ones among
+        # them on which a rule failed, and the number of deferred works
+        # pending per file, see popFinished
+        self.finished = []
+        self.failedFiles = set()
+        self.deferred = {}
+
+        # (collection, target collection, objects, registrations) waiting
+        # for replication, replications running in the background and the
+        # iRODS session of the replication thread, see ReplicationRule
+        self.replicaCollection = None
+        self.replications = []
+        self.replicator = None
+        self.replicaIrods = None
+
+        # metadata of the objects of the current collection, see _isDone
+        self.avuCollection = None
+        self.avus = {}
 
     def register(self):
         """Register the new data object into iRODS."""
 
         self.log.info("iREG on iRODS of : "+self.digitObjProperty['file'])
         try:
-            self.irods.doRegister( self.digitObjProperty['dirname'], self.digitObjProperty['collname'], self.digitObjProperty['filename'])
+            return self.irods.doRegister( self.digitObjProperty['dirname'], self.digitObjProperty['collname'], self.digitObjProperty['filename'])
         except Exception as ex:
             self.log.error("Could not execute a doRegister ")
             self.log.error(ex)
-            pass
+            return False
 
 
     def put(self):
@@ -82,16 +134,87 @@ class sequencer(object):
 
         self.log.info("iPUT on iRODS of : "+self.digitObjProperty['file'])
         try:
-            self.irods.doPut(self.digitObjProperty['dirname'],
-                             self.digitObjProperty['collname'],
-                             self.digitObjProperty['filename'],
-                             purge_cache=True,
-                             register_checksum=True,
-                             check='updated')
+            return self.irods.doPut(self.digitObjProperty['dirname'],
+                                    self.digitObjProperty['collname'],
+                                    self.digitObjProperty['filename'],
+                                    purge_cache=True,
+                                    register_checksum=True,
+                                    check='updated')
         except Exception as ex:
             self.log.error("Could not execute a doPut ")
             self.log.error(ex)
-            pass
+            return False
+
+
+    def bundlePut(self, digitObjProperties):
+        """Puts the files smaller than IRODS.BUNDLE_THRESHOLD bytes in
+        bundles of up to IRODS.BUNDLE_MAX_FILES files per collection,
+        before their sequences run. The put policy of the sequences then
+        finds them already in iRODS. Only applies when the ingestion rule
+        is put or ingest (for the files that are not registered in place),
+        and when the threshold is not 0.
+
+        Parameters
+        ----------
+        digitObjProperties : `list`
+            The properties of the digital objects about to be processed.
+        """
+
+        threshold = self.config['IRODS']['BUNDLE_THRESHOLD']
+        if not threshold or self.irods is None:
+            return
+        if 'INGESTION' not in self.ruleMap['SEQUENCE'] or self.ruleMap['RULE_MAP']['INGESTION'] not in ('put', 'ingest'):
+            return
+
+        bundles = collections.defaultdict(list)
+        for digitObjProperty in digitObjProperties:
+            # files registered in place are not transferred
+            if self.ruleMap['RULE_MAP']['INGESTION'] == 'ingest' and self.irods.getVaultPath(digitObjProperty['file']) is not None:
+                continue
+            try:
+                if os.path.getsize(digitObjProperty['file']) < threshold:
+                    bundles[digitObjProperty['collname']].append(digitObjProperty['file'])
+            except OSError:
+                continue
+
+        maxFiles = self.config['IRODS']['BUNDLE_MAX_FILES']
+        for collname, files in bundles.items():
+            for i in range(0, len(files), maxFiles):
+                try:
+                    created = self.irods.doBundlePut(collname, files[i:i + maxFiles],
+                                                     self.ruleMap['RULE_PATHS']['BUNDLE'],
+                                                     purge_cache=True,
+                                                     register_checksum=True)
+                    self.summary['INGESTION bundled'] += len(created)
+                except Exception as ex:
+                    self.log.error("Could not execute a doBundlePut in " + collname)
+                    self.log.error(ex)
+
+
+    def ingest(self):
+        """Defines an ingestion policy that registers the file in place when
+        the archive is on a vault visible by the iRODS resource server (see
+        IRODS.VAULT_MAP), and puts it otherwise.
+
+        In both cases, the file is only ingested if it is not already
+        registered in iRODS or if it is registered with a different
+        checksum, and the file's SHA256 checksum is registered in iRODS.
+        """
+
+        if self.irods.getVaultPath(self.digitObjProperty['file']) is None:
+            return self.put()
+
+        self.log.info("iREG in place on iRODS of : "+self.digitObjProperty['file'])
+        try:
+            return self.irods.doRegister(self.digitObjProperty['dirname'],
+                                         self.digitObjProperty['collname'],
+                                         self.digitObjProperty['filename'],
+                                         register_checksum=True,
+                                         check='updated')
+        except Exception as ex:
+            self.log.error("Could not execute a doRegister ")
+            self.log.error(ex)
+            return False
 
 
     def testRule(self):
@@ -105,7 +228,31 @@ class sequencer(object):
         except Exception as ex:
             self.log.error("Could not execute a rule")
             self.log.error(ex)
-            pass
+            return False
+
+
+    def _isDone(self, rule):
+        """Whether the current object already has the metadata attribute
+        set by a rule (see RULE_AVUS). The attributes of all the objects
+        of a collection are fetched with one query when the sequence gets
+        to the collection. The skip is counted in the summary."""
+
+        collname = self.digitObjProperty['collname']
+        if self.avuCollection != collname:
+            self.avuCollection = collname
+            try:
+                self.avus = self.irods.getCollectionAVUs(collname, RULE_AVUS.values())
+            except Exception as ex:
+                self.log.error("Could not get the metadata of collection "+collname)
+                self.log.error(ex)
+                self.avus = {}
+
+        if RULE_AVUS[rule] not in self.avus.get(self.digitObjProperty['filename'], {}):
+            return False
+
+        self.log.info("skip "+rule+" rule, "+RULE_AVUS[rule]+" already set on : "+self.digitObjProperty['object_path'])
+        self.summary[rule + ' skipped'] += 1
+        return True
 
 
     #..................................... PID - 
@@ -113,6 +260,16 @@ class sequencer(object):
     # Exec Rule:  Make a PID and register into EPIC
     #
     def PidRule(self):
+
+        if self._isDone('PID'):
+            return
+
+        # batched mode: queue the object, PIDs are made per collection
+        # before the sequence of the next file, see doSequence
+        if self.pidBatch:
+            self.pidCollection = self.digitObjProperty['collname']
+            self.pidQueue.append((self.digitObjProperty['object_path'], self.digitObjProperty['file']))
+            return DEFERRED
         
         # rule execution w params (called w rule-body, params, and output -must-)
         self.log.info("call PID rule  on  : "+self.digitObjProperty['file'])
@@ -121,7 +278,48 @@ class sequencer(object):
         retValue = self.irods.rulePIDsingle( self.digitObjProperty['object_path'], self.ruleMap['RULE_PATHS']['PID'])
         #print (retValue)
         
-        #return retValue
+        return bool(retValue)
+
+
+    def flushPids(self):
+        """Makes the PIDs of the queued objects with a single execution of
+        the PID_BATCH rule. Objects without a PID after the batch get one
+        from the single-object PID rule. The outcome is recorded for the
+        file of each object, see `_finishDeferred`. Must be called after the
+        last sequence when PID_BATCH is set."""
+
+        if not self.pidQueue:
+            return
+
+        queue, self.pidQueue = self.pidQueue, []
+        object_paths = [object_path for object_path, file in queue]
+
+        self.log.info("call PID BATCH rule on %d object(s) of %s" % (len(object_paths), self.pidCollection))
+        try:
+            pids = self.irods.rulePIDbatch(object_paths, self.ruleMap['RULE_PATHS']['PID_BATCH'])
+        except Exception as ex:
+            self.log.error("Could not execute the PID batch rule")
+            self.log.error(ex)
+            pids = {}
+
+        for object_path, file in queue:
+            if object_path in pids:
+                self.log.info(" PID for digitalObject: "+object_path+" is: "+pids[object_path])
+                self.summary['PID batched'] += 1
+                self._finishDeferred(file, True)
+                continue
+
+            # fall back to the single-object rule
+            try:
+                if not self.irods.rulePIDsingle(object_path, self.ruleMap['RULE_PATHS']['PID']):
+                    raise Exception("PID rule failed on "+object_path)
+                self.summary['PID batch fallback'] += 1
+                self._finishDeferred(file, True)
+            except Exception as ex:
+                self.log.error("Could not execute a rule for PID on "+object_path)
+                self.log.error(ex)
+                self.summary['PID failed'] += 1
+                self._finishDeferred(file, False)
 
 
     #..................................... REPLICATION -  
@@ -129,6 +327,20 @@ class sequencer(object):
     # Exec Rule: DO a Remote Replica 
     #
     def ReplicationRule(self):
+
+        if self._isDone('REPLICA'):
+            return
+
+        # collection mode: the objects of a collection are replicated with
+        # one rule call in the background, once the sequence moves to
+        # another collection
+        if self.config['IRODS']['REPLICATION_MODE'] == 'collection':
+            collname = self.digitObjProperty['collname']
+            if self.replicaCollection is None or self.replicaCollection[0] != collname:
+                self.flushReplications()
+                self.replicaCollection = (collname, os.path.dirname(self.digitObjProperty['target_path']), [], [])
+            self.replicaCollection[2].append((self.digitObjProperty['object_path'], self.digitObjProperty['file']))
+            return DEFERRED
         
         self.log.info("call REPLICATION rule  on self.digitObjProperty['file'] : "+self.digitObjProperty['file'])
 
@@ -138,7 +350,158 @@ class sequencer(object):
         # make a replica
         retValue = self.irods.ruleReplication(self.digitObjProperty['object_path'], self.digitObjProperty['target_path'], self.ruleMap['RULE_PATHS']['REPLICA'])
 
-        #return retValue
+        return bool(retValue)
+
+
+    def _replicateLater(self, objects, target, registrations=()):
+        """Replicates the given (object path, file) into the target
+        collection in the background, then registers the given (object
+        path, target path, file) remote replicas, see `_replicate`."""
+
+        if self.replicator is None:
+            self.replicator = ThreadPoolExecutor(max_workers=1)
+
+        future = self.replicator.submit(self._replicate, list(objects), target, list(registrations))
+        self.replications.append((objects, registrations, future))
+
+
+    def _replicate(self, objects, target, registrations):
+        """Replicates objects into the target collection with one execution
+        of the REPLICA_BATCH rule, then registers the remote replicas of the
+        objects replicated. Runs in the replication thread, with its own
+        iRODS session.
+
+        Returns
+        -------
+        `list`
+            The (step, file, ok) outcome of each replication and
+            registration.
+        """
+
+        if self.replicaIrods is None:
+            import irodsmanager
+            self.replicaIrods = irodsmanager.irodsDAO(self.config, self.log)
+
+        object_paths = [object_path for object_path, file in objects]
+        replicated = set()
+        if object_paths:
+            replicated = self.replicaIrods.ruleReplicationBatch(object_paths, target, self.ruleMap['RULE_PATHS']['REPLICA_BATCH'])
+
+        results = [('REPLICA', file, object_path in replicated) for object_path, file in objects]
+        failed = set(object_paths) - replicated
+
+        for object_path, target_path, file in registrations:
+            ok = (object_path not in failed and
+                  bool(self.replicaIrods.ruleRegistration(object_path, target_path, self.ruleMap['RULE_PATHS']['REGISTER'])))
+            results.append(('REGISTER', file, ok))
+
+        return results
+
+
+    def flushReplications(self):
+        """Queues the replication of the objects of the current collection,
+        and records the outcome of the background replications that are
+        done. Returns right away."""
+
+        if self.replicaCollection is not None:
+            collname, target, objects, registrations = self.replicaCollection
+            self.log.info("queue REPLICATION of %d object(s) of collection : %s" % (len(objects), collname))
+            self._replicateLater(objects, target, registrations)
+            self.replicaCollection = None
+
+        running = []
+        for objects, registrations, future in self.replications:
+            if not future.done():
+                running.append((objects, registrations, future))
+                continue
+
+            if future.exception() is not None:
+                self.log.error("Could not replicate %d object(s)" % len(objects))
+                self.log.error(future.exception())
+                results = ([('REPLICA', file, False) for object_path, file in objects] +
+                           [('REGISTER', file, False) for object_path, target_path, file in registrations])
+            else:
+                results = future.result()
+
+            for step, file, ok in results:
+                self.summary[step + (' done' if ok else ' failed')] += 1
+                self._finishDeferred(file, ok)
+        self.replications = running
+
+
+    def waitReplications(self):
+        """Queues the replication of the current collection and waits for
+        all the background replications."""
+
+        self.flushReplications()
+
+        if self.replicator is not None:
+            self.replicator.shutdown(wait=True)
+            self.replicator = None
+
+        self.flushReplications()
+
+
+    def reconcileReplicas(self, digitObjProperties):
+        """Checks in bulk, per collection, that the given objects are
+        replicated (they carry the REPLICA_AVU metadata attribute), and
+        replicates again the objects that are not. Returns right away, see
+        `waitReplications`.
+
+        Parameters
+        ----------
+        digitObjProperties : `list`
+            The properties of the digital objects to check.
+        """
+
+        byCollection = collections.defaultdict(list)
+        for digitObjProperty in digitObjProperties:
+            byCollection[digitObjProperty['collname']].append(digitObjProperty)
+
+        for collname, properties in byCollection.items():
+            try:
+                avus = self.irods.getCollectionAVUs(collname, [REPLICA_AVU])
+            except Exception as ex:
+                self.log.error("Could not get the replica metadata of "+collname)
+                self.log.error(ex)
+                continue
+
+            objects = []
+            registrations = []
+            for digitObjProperty in properties:
+                if REPLICA_AVU in avus.get(digitObjProperty['filename'], {}):
+                    self.summary['REPLICA reconciled'] += 1
+                    continue
+
+                self.log.info("queue REPLICATION again of : "+digitObjProperty['object_path'])
+                objects.append((digitObjProperty['object_path'], digitObjProperty['file']))
+                self.summary['REPLICA requeued'] += 1
+
+                # the remote replica is registered again too, if the sequence does
+                if 'REGISTER' in self.ruleMap['SEQUENCE']:
+                    registrations.append((digitObjProperty['object_path'], digitObjProperty['target_path'], digitObjProperty['file']))
+
+            if objects:
+                self._replicateLater(objects, os.path.dirname(properties[0]['target_path']), registrations)
+
+
+    def flush(self):
+        """Runs the work deferred by the rules: batched PIDs and collection
+        replications. Background replications are not waited for."""
+
+        self.flushPids()
+        self.flushReplications()
+
+        # metadata may have changed since it was fetched
+        self.avuCollection = None
+
+
+    def close(self):
+        """Runs the deferred work and waits for the background replications.
+        Must be called after the last sequence."""
+
+        self.flushPids()
+        self.waitReplications()
 
 
     #..................................... REGISTRATION_REPLICA -  
@@ -146,13 +509,24 @@ class sequencer(object):
     # Exec Rule: Registration of Remote PID into local ICAT
     #
     def RegistrationRule(self):
+
+        if self._isDone('REGISTER'):
+            return
+
+        # collection mode: the remote replica is registered once the
+        # background replication of the collection is done
+        if self.replicaCollection is not None and self.replicaCollection[0] == self.digitObjProperty['collname']:
+            self.replicaCollection[3].append((self.digitObjProperty['object_path'],
+                                              self.digitObjProperty['target_path'],
+                                              self.digitObjProperty['file']))
+            return DEFERRED
         
         self.log.info("call REGISTRATION_REPLICA rule  on  : "+self.digitObjProperty['file'])
 
         # make a registration
         retValue = self.irods.ruleRegistration( self.digitObjProperty['object_path'], self.digitObjProperty['target_path'], self.ruleMap['RULE_PATHS']['REGISTER'])
 
-        #return retValue
+        return bool(retValue)
 
 
     def DublinCoreMeta(self):
@@ -170,7 +544,7 @@ class sequencer(object):
         except Exception as ex:
             self.log.error("Could not process DublinCore metadata")
             self.log.error(ex)
-            pass        
+            return False
 
 
     #..................................... WFCATALOG_META -
@@ -181,12 +555,18 @@ class sequencer(object):
         
         self.log.info("called collect WF CATALOG METADATA of : "+self.digitObjProperty['file'])
         try:
-            self.WFcollector.collectMetadata(self.digitObjProperty['file'])
+            if self.WFcollector.collectMetadata(self.digitObjProperty['file']) is False:
+                return False
             self.log.info(" WF METADATA for digitalObject: "+self.digitObjProperty['object_path']+" is: OK" )
+        except MetadataTimeout as ex:
+            self.log.error("Timed out computing WF metadata")
+            self.log.error(ex)
+            self.summary['timed out files'] += 1
+            return False
         except Exception as ex:
             self.log.error("Could not compute WF metadata")
             self.log.error(ex)
-            pass          
+            return False
         
 
     def purgeTemp(self):
@@ -202,11 +582,48 @@ class sequencer(object):
         except Exception as ex:
             self.log.error("Could not execute a purgeTemp")
             self.log.error(ex)
-            pass
+            return False
+
+
+    def _finishDeferred(self, file, ok):
+        """Records the outcome of a deferred work of a file. The file is
+        finished once all its deferred works are done. Files without
+        deferred works (see `reconcileReplicas`) are ignored."""
+
+        if file not in self.deferred:
+            return
+
+        if not ok:
+            self.failedFiles.add(file)
+
+        self.deferred[file] -= 1
+        if not self.deferred[file]:
+            del self.deferred[file]
+            self.finished.append(file)
+
+
+    def popFinished(self):
+        """Returns the files whose sequence and deferred work are done since
+        the previous call, as (file, ok) pairs. ok is False when a rule
+        failed on the file."""
+
+        finished, self.finished = self.finished, []
+        results = [(file, file not in self.failedFiles) for file in finished]
+        self.failedFiles.difference_update(finished)
+
+        return results
 
 
     def doSequence(self, digitObjProperty):
-        """Runs the sequence defined by the rule map on the file given by digitObjProperty."""
+        """Runs the sequence defined by the rule map on the file given by
+        digitObjProperty. A rule fails when it raises or returns False, and
+        its work is deferred when it returns DEFERRED. The file is finished
+        when the sequence and its deferred works are done."""
+
+        # make the queued PIDs of the previous collection, or of a full batch
+        if self.pidQueue and (self.pidCollection != digitObjProperty['collname'] or
+                              len(self.pidQueue) >= self.config['IRODS']['PID_BATCH_SIZE']):
+            self.flushPids()
 
         # load current property
         self.digitObjProperty = digitObjProperty
@@ -217,14 +634,32 @@ class sequencer(object):
         self.log.info("dirname: "+ digitObjProperty["dirname"])
         self.log.info("filename: "+ digitObjProperty["filename"])
 
+        self.summary['sequences'] += 1
+
+        file = digitObjProperty['file']
+
         # for each step apply rule
         for step in self.ruleMap['SEQUENCE']:
             try:
                 self.log.info("Applying rule: " + self.ruleMap['RULE_MAP'][step])
-                getattr(self, self.ruleMap['RULE_MAP'][step])()
+                result = getattr(self, self.ruleMap['RULE_MAP'][step])()
+                if result is False:
+                    self.summary[step + ' failed'] += 1
+                    self.failedFiles.add(file)
+                elif result is DEFERRED:
+                    self.summary[step + ' queued'] += 1
+                    self.deferred[file] = self.deferred.get(file, 0) + 1
+                else:
+                    self.summary[step + ' done'] += 1
             except Exception as ex:
-                self.log.error("Sequence error, could not execute rule: "+self.steps_definition[step])
+                self.log.error("Sequence error, could not execute rule: "+self.ruleMap['RULE_MAP'][step])
                 self.log.error(ex)
+                self.summary[step + ' failed'] += 1
+                self.failedFiles.add(file)
                 pass
+
+        # a file with deferred works is finished by _finishDeferred
+        if file not in self.deferred:
+            self.finished.append(file)
                     
 
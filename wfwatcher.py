@@ -0,0 +1,246 @@
+#! /usr/bin/env python
+"""
+#
+#
+#
+
+"""
+
+import os
+import time
+import datetime
+
+
+class ArchiveWatcher():
+    """Watches the archive for new or modified files and yields them once
+    they are settled, i.e. their size and modification time did not change
+    for WATCH.SETTLE_SECONDS, and their day is over (UTC). The file of the
+    current day is held until the day rolls over, so it is only processed
+    once it is complete.
+
+    Uses inotify (through the optional ``inotify_simple`` package) on the
+    years of today and yesterday of ARCHIVE_ROOT when WATCH.USE_INOTIFY is
+    set. Otherwise, or when inotify is not available (e.g. NFS mounts, where
+    it does not see remote writes), the files of today and yesterday are
+    polled every WATCH.POLL_INTERVAL seconds.
+
+    At startup, and when inotify events were lost, the files of the last
+    WATCH.CATCHUP_DAYS days that were not processed yet are picked up, see
+    `_rescan`.
+
+    Attributes
+    ----------
+    config : `dict`
+        The configuration options loaded from the config file. See config.json.
+    log : `logging.Logger`
+        The WFCatalog Logger object.
+    WFcollector : `wfcollector.WFCatalogCollector`
+        Collector used to list the archive files and to filter them.
+    """
+
+    def __init__(self, config, log, WFcollector):
+
+        self.config = config
+        self.log = log
+        self.WFcollector = WFcollector
+
+        self.settle = self.config['WATCH']['SETTLE_SECONDS']
+        self.pollInterval = self.config['WATCH']['POLL_INTERVAL']
+        self.catchUpDays = self.config['WATCH']['CATCHUP_DAYS']
+
+        # path -> (identity, time since which the identity is unchanged)
+        self.pending = {}
+        # path -> identity of the files seen by polling
+        self.known = {}
+
+        self.inotify = None
+        if self.config['WATCH']['USE_INOTIFY']:
+            self._setupInotify()
+
+    def _today(self):
+        """Returns the current UTC date."""
+
+        return datetime.datetime.now(datetime.timezone.utc).date()
+
+    def _setupInotify(self):
+        """Watches ARCHIVE_ROOT and the directories of the years of today
+        and yesterday."""
+
+        try:
+            from inotify_simple import INotify, flags
+        except ImportError:
+            self.log.warning("inotify_simple is not installed, falling back to polling")
+            return
+
+        self.flags = flags
+        self.inotify = INotify()
+        self.watches = {}
+
+        self._addWatches()
+
+        self.log.info("Watching %d directories with inotify" % len(self.watches))
+
+    def _addWatches(self):
+        """Adds the watches on ARCHIVE_ROOT and on the directories of the
+        years of today and yesterday."""
+
+        today = self._today()
+        years = set(date.strftime("%Y") for date in (today - datetime.timedelta(days=1), today))
+
+        self._addWatch(self.config['ARCHIVE_ROOT'], recursive=False)
+        for year in sorted(years):
+            self._addWatch(os.path.join(self.config['ARCHIVE_ROOT'], year))
+
+    def _addWatch(self, directory, recursive=True):
+        """Adds an inotify watch on a directory and, optionally, on all its
+        subdirectories."""
+
+        if not os.path.isdir(directory):
+            return
+
+        mask = (self.flags.CLOSE_WRITE | self.flags.MOVED_TO | self.flags.MODIFY |
+                self.flags.CREATE)
+        try:
+            self.watches[self.inotify.add_watch(directory, mask)] = directory
+        except OSError as ex:
+            self.log.error("Could not watch directory %s" % directory)
+            self.log.error(ex)
+            return
+
+        if recursive:
+            for entry in os.scandir(directory):
+                if entry.is_dir():
+                    self._addWatch(entry.path)
+
+    def _identity(self, file):
+        """Returns the (size, mtime_ns) of a file, or None if it does not exist."""
+
+        try:
+            stat = os.stat(file)
+        except OSError:
+            return None
+
+        return (stat.st_size, stat.st_mtime_ns)
+
+    def _touch(self, file):
+        """Marks a file as modified, if it passes the collector filters."""
+
+        if not self.WFcollector._passFilter(os.path.basename(file)):
+            return
+
+        self.pending[file] = (self._identity(file), time.time())
+
+    def _isComplete(self, file):
+        """Whether the day of a file is over (UTC). Files whose name has no
+        day are considered complete."""
+
+        try:
+            return self.WFcollector._getDateFromFile(file).date() < self._today()
+        except Exception:
+            return True
+
+    def _rescan(self):
+        """Marks the files of the last WATCH.CATCHUP_DAYS days that are new
+        or changed since they were processed (if the file index is enabled),
+        or that have no daily stream in the database otherwise."""
+
+        today = self._today()
+        dates = [today - datetime.timedelta(days=n) for n in range(self.catchUpDays - 1, -1, -1)]
+        files = self.WFcollector._collectFilesFromDates(dates)
+
+        if self.WFcollector.fileIndex is not None:
+            files = self.WFcollector.fileIndex.getChangedFiles(files)
+        else:
+            files = self.WFcollector._getNewFiles(files)
+
+        self.log.info("Catching up on %d file(s) of the last %d day(s)" % (len(files), self.catchUpDays))
+
+        for file in files:
+            self._touch(file)
+
+    def _readEvents(self, timeout):
+        """Waits up to timeout seconds for inotify events and marks the
+        modified files."""
+
+        for event in self.inotify.read(timeout=int(timeout * 1000)):
+
+            # Events were dropped, look for the files they were about
+            if event.mask & self.flags.Q_OVERFLOW:
+                self.log.warning("inotify event queue overflowed, rescanning the archive")
+                self._addWatches()
+                self._rescan()
+                continue
+
+            # The directory was removed or unmounted
+            if event.mask & self.flags.IGNORED:
+                self.watches.pop(event.wd, None)
+                continue
+
+            if event.wd not in self.watches:
+                continue
+
+            path = os.path.join(self.watches[event.wd], event.name)
+
+            if event.mask & self.flags.ISDIR:
+                # Watch new year, network, station, channel directories
+                if event.mask & (self.flags.CREATE | self.flags.MOVED_TO):
+                    self._addWatch(path)
+            elif os.path.isfile(path):
+                self._touch(path)
+
+    def _poll(self):
+        """Marks the files of today and yesterday that were modified since
+        the previous poll. The first poll only records the files, the files
+        present at startup are marked by `_rescan`."""
+
+        today = self._today()
+        files = self.WFcollector._collectFilesFromDates([today - datetime.timedelta(days=1), today])
+
+        first = not self.known
+        for file in files:
+            identity = self._identity(file)
+            if not first and self.known.get(file) != identity:
+                self._touch(file)
+            self.known[file] = identity
+
+    def _popSettled(self):
+        """Returns the pending files whose identity has not changed for the
+        settle time and whose day is over, and forgets them."""
+
+        now = time.time()
+        settled = []
+
+        for file, (identity, since) in list(self.pending.items()):
+            current = self._identity(file)
+
+            if current is None:
+                del self.pending[file]
+            elif current != identity:
+                self.pending[file] = (current, now)
+            elif now - since >= self.settle and self._isComplete(file):
+                del self.pending[file]
+                settled.append(file)
+
+        return sorted(settled, key=os.path.basename)
+
+    def settledFiles(self):
+        """Yields lists of settled files, forever."""
+
+        lastPoll = None
+        tick = min(self.settle, self.pollInterval, 5) or 1
+
+        self._rescan()
+
+        while True:
+
+            if self.inotify is not None:
+                self._readEvents(tick)
+            else:
+                if lastPoll is None or time.time() - lastPoll >= self.pollInterval:
+                    self._poll()
+                    lastPoll = time.time()
+                time.sleep(tick)
+
+            settled = self._popSettled()
+            if settled:
+                yield settled